@@ -0,0 +1,66 @@
+import time
+
+import torch
+from cellpose import models
+
+
+class CellposeSingleton:
+    """Process-wide Cellpose models, loaded once and shared by all images, wells and measurements of a run."""
+    _models = {}
+    _load_time = 0.0
+    _hits = 0
+    _gpu = None
+
+    @classmethod
+    def gpu_available(cls):
+        """Checked once per process, so CPU-only machines skip all GPU tooling afterwards."""
+        if cls._gpu is None:
+            cls._gpu = torch.cuda.is_available()
+            print(f"Cellpose device: {'GPU' if cls._gpu else 'CPU'}")
+        return cls._gpu
+
+    @classmethod
+    def get_model(cls, model_type, gpu=None, diameter=0):
+        """Cached model for (model_type, device, diameter mode), on the GPU whenever one is available.
+
+        Without a diameter Cellpose has to estimate it, which needs the size model as well, otherwise the
+        bare CellposeModel is enough.
+        """
+        if gpu is None:
+            gpu = cls.gpu_available()
+        diameter_mode = "fixed" if diameter else "estimate"
+        key = (model_type, "gpu" if gpu else "cpu", diameter_mode)
+        if key in cls._models:
+            cls._hits += 1
+            return cls._models[key]
+
+        start_time = time.perf_counter()
+        if diameter_mode == "estimate":
+            model = models.Cellpose(gpu=gpu, model_type=model_type)
+        else:
+            model = models.CellposeModel(gpu=gpu, model_type=model_type)
+        load_time = time.perf_counter() - start_time
+        cls._load_time += load_time
+        print(f"Loaded Cellpose model {key} in {load_time:.2f} s")
+
+        cls._models[key] = model
+        return model
+
+    @classmethod
+    def print_stats(cls):
+        if not cls._models:
+            return
+        average_load = cls._load_time / len(cls._models)
+        print(f"Cellpose models: {len(cls._models)} loaded in {cls._load_time:.2f} s, reused {cls._hits} times, "
+              f"about {cls._hits * average_load:.1f} s of model loading saved")
+
+    @classmethod
+    def dispose(cls):
+        if not cls._models:
+            return
+        cls.print_stats()
+        cls._models = {}
+        cls._load_time = 0.0
+        cls._hits = 0
+        if cls._gpu:
+            torch.cuda.empty_cache()
@@ -4,20 +4,71 @@ import json
 import csv
 import time
 import re
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from cellpose import models, io, utils
+from cellpose import io, utils
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.use('Agg')  # Use non-interactive backend
-import GPUtil
+from PIL import Image
 import tifffile
+import torch
+
+from HiConA.Utilities.IOread import create_directory, read_image, read_pixel_size, save_label_image, save_label_rle
+from HiConA.Utilities.Image_Utils import render_label_overlay
+from HiConA.Backend.Cellpose_singleton import CellposeSingleton
+from HiConA.Backend.HiConATiledSegmentation import segment_tiled
+from HiConA.Backend.HiConAMeasurement import measure_labels
+from HiConA.Backend.HiConADiameterCache import HiConADiameterCache
+
+
+def run_cellpose(images, cellpose_config, **eval_kwargs):
+    """One model.eval call on an image, a list of images or a stack of images, returns (masks, diameters)."""
+    # The model is loaded once per process, on the GPU when there is one
+    model = CellposeSingleton.get_model(cellpose_config["model"], diameter=cellpose_config['diameter'])
+
+    result = model.eval(
+        images,
+        diameter = cellpose_config['diameter'],
+        channels = [cellpose_config["channel1"], cellpose_config['channel2']],
+        flow_threshold = cellpose_config['flow_threshold'],
+        cellprob_threshold = cellpose_config['cellprob_threshold'],
+        niter = cellpose_config['niter'],
+        batch_size = cellpose_config['batch_size'],
+        do_3D = False,
+        **eval_kwargs
+    )
+    # Only Cellpose (with the size model) returns the estimated diameters
+    diams = result[3] if len(result) == 4 else cellpose_config['diameter']
+    return result[0], diams
+
+
+def segment_block(block, cellpose_config):
+    """Segments one (C, Y, X) block of a tiled image, module level so it can run in a worker process."""
+    masks, diams = run_cellpose(block, cellpose_config)
+    return masks, float(np.ravel(diams)[0])
+
+
+def _init_cpu_worker(num_threads):
+    """Pins the torch thread budget of a CPU worker, so K workers share the cores without oversubscribing them."""
+    torch.set_num_threads(num_threads)
+    HiConACellposeProcessor.in_worker = True
+
+
+def _segment_image_path(image_path, diameter=None):
+    """Segments one image in a CPU worker and returns its processing_data.csv row, the worker keeps its own model."""
+    processor = HiConACellposeProcessor(read_image(image_path), image_path, diameter)
+    return processor.segment()
 
-from HiConA.Utilities.IOread import create_directory
 
 class HiConACellposeProcessor:
-    def __init__(self, image, image_path):
+    in_worker = False  # set in the CPU worker processes, which must not start a pool of their own
+    WELL_PATTERN = r"r\d+c\d+$"
+
+    def __init__(self, image, image_path, diameter=None):
         self.cellpose_config = self._load_cellpose_config()
+        if diameter:
+            # Diameter calibrated on the plate, replaces the size model
+            self.cellpose_config['diameter'] = diameter
         self.seg_ch = [self.cellpose_config["channel1"], self.cellpose_config['channel2']]
         self.diameter_data = []
 
@@ -25,11 +76,12 @@ class HiConACellposeProcessor:
         self.image_path = image_path
         self.image_name = os.path.basename(os.path.normpath(self.image_path))
 
-        self.well_path, self.measurement_path = self._get_well_path(image_path, r"r\d+c\d+$")
+        self.well_path, self.measurement_path = self._get_well_path(image_path, self.WELL_PATTERN)
         
         self.data_processing_file_path = self._generate_processing_data_file()
     
-    def _load_cellpose_config(self):
+    @staticmethod
+    def _load_cellpose_config():
         cellpose_config_f = os.path.join(os.path.dirname(__file__), '..', 'GUI', "cellpose_config.json")
         if os.path.isfile(cellpose_config_f):
             with open(cellpose_config_f, "r+") as f:
@@ -38,7 +90,8 @@ class HiConACellposeProcessor:
         else:
             return None
         
-    def _get_well_path(self, image_path, pattern):
+    @staticmethod
+    def _get_well_path(image_path, pattern):
         current = Path(image_path).resolve()
         compiled_pattern = re.compile(pattern)
 
@@ -53,7 +106,8 @@ class HiConACellposeProcessor:
         if not os.path.exists(file_path):
             with open(file_path, mode='w', newline="") as f:
                 writer = csv.writer(f)
-                writer.writerow(['Filename', 'Estimated Diameter', 'Processing Time [s]'])
+                # Images segmented in one Cellpose batch share its time, averaged over the batch size
+                writer.writerow(['Filename', 'Estimated Diameter', 'Processing Time [s] (batch average)', 'Batch Size'])
                 f.close()
         
         return file_path
@@ -64,10 +118,86 @@ class HiConACellposeProcessor:
         return dummy_mask
     
     def _print_gpu_usage(self):
+        if not CellposeSingleton.gpu_available():
+            return
+        import GPUtil
         gpus = GPUtil.getGPUs()
         for gpu in gpus:
             print(f"GPU ID: {gpu.id}, GPU Load: {gpu.load*100}%, Memory Used: {gpu.memoryUsed}MB, Memory Total: {gpu.memoryTotal}MB")
 
+    def _run_cellpose(self, images, **eval_kwargs):
+        return run_cellpose(images, self.cellpose_config, **eval_kwargs)
+
+    def _use_tiles(self):
+        tile_size = self.cellpose_config.get("tile_size", 0)
+        return tile_size > 0 and max(self.image.shape[-2:]) > tile_size
+
+    def _run_cellpose_tiled(self):
+        """Segments a large image in overlapping blocks into a temporary uint32 label memmap next to the ROIs.
+
+        Only the blocks in flight are held in memory, labels are merged across the seams. Returns
+        the labels and the median diameter of the blocks.
+        """
+        labels_path = os.path.join(self.save_dir, self.image_name.replace('.tiff', '_labels_raw.tiff'))
+        labels = tifffile.memmap(labels_path, shape=self.image.shape[-2:], dtype=np.uint32, bigtiff=True)
+        diams = segment_tiled(self.image, partial(segment_block, cellpose_config=self.cellpose_config), labels,
+                              block_size=self.cellpose_config["tile_size"],
+                              overlap=self.cellpose_config.get("tile_overlap", 256),
+                              max_workers=0 if self.in_worker else self.cellpose_config.get("tile_workers", 0))
+        labels.flush()
+        return labels, float(np.median(diams))
+
+    def _save_masks(self, masks):
+        """Saves the masks as ImageJ ROI zip, label image or both, as set by mask_output in cellpose_config.json.
+
+        The label image is a compressed tiled TIFF, with label_rle also a run-length encoded .npz,
+        both can be read back with IOread.load_label_image without rebuilding polygons. The ImageJ macro step
+        rebuilds a missing ROI zip from the label image.
+        """
+        mask_output = self.cellpose_config.get("mask_output", "ROI zip")
+        base_path = os.path.join(self.save_dir, self.image_name.replace('.tiff', ''))
+
+        if mask_output in ("ROI zip", "both"):
+            if not utils.outlines_list(masks):
+                print(f"No outlines found for {self.image_name}")
+                raise ValueError("No outlines found")
+            io.save_rois(masks, base_path)
+        if mask_output in ("label image", "both"):
+            if not np.any(masks):
+                print(f"No labels found for {self.image_name}")
+                raise ValueError("No labels found")
+            save_label_image(base_path + "_labels.tiff", masks, compression=self.cellpose_config.get("label_compression", "zlib"))
+            if self.cellpose_config.get("label_rle", 0):
+                save_label_rle(base_path + "_labels_rle.npz", masks)
+
+    def _save_segmentation(self, masks, diams, processing_time, batch_size=1):
+        """Saves the ROIs of one image and returns its row for processing_data.csv."""
+        if masks is None or len(masks) == 0:
+            print(f'No masks found for {self.image_name}')
+            raise ValueError("No masks found")
+
+        estimated_diameter = diams if isinstance(diams, (int, float)) else diams[0]
+        print(f'Estimated diameter for {self.image_name}: {estimated_diameter}')
+
+        self._save_masks(masks)
+
+        # Print GPU usage after processing each image
+        self._print_gpu_usage()
+
+        return [self.image_path, estimated_diameter, processing_time, batch_size]
+
+    def _save_dummy_mask(self):
+        # Create a more substantial dummy mask
+        dummy_mask = self._create_dummy_mask(self.image.shape)
+
+        # Save the dummy mask like the real masks
+        try:
+            self._save_masks(dummy_mask)
+        except Exception as save_e:
+            print(f"Error saving dummy mask for {self.image_name}: {save_e}")
+
+        self._print_gpu_usage()
+
     def _cellpose_segmentation(self):
         try:
             print(f"Processing {self.image_name}, Image shape: {self.image.shape}, dtype: {self.image.dtype}")
@@ -75,19 +205,10 @@ class HiConACellposeProcessor:
             # Start timer
             start_time = time.time()
 
-            # Run cellpose
-            model = models.Cellpose(gpu=True, model_type=self.cellpose_config["model"])
-            
-            masks, flows, styles, diams = model.eval(
-                self.image,
-                diameter = self.cellpose_config['diameter'],
-                channels = self.seg_ch,
-                flow_threshold = self.cellpose_config['flow_threshold'],
-                cellprob_threshold = self.cellpose_config['cellprob_threshold'],
-                niter = self.cellpose_config['niter'],
-                batch_size = self.cellpose_config['batch_size'],
-                do_3D = False
-            )
+            if self._use_tiles():
+                masks, diams = self._run_cellpose_tiled()
+            else:
+                masks, diams = self._run_cellpose(self.image)
 
             # End timer
             end_time = time.time()
@@ -95,69 +216,232 @@ class HiConACellposeProcessor:
             processing_time = end_time-start_time
             print(f'Processing time for {self.image_name}: {processing_time}')
 
-            if masks is None or len(masks) == 0:
-                print(f'No masks found for {self.image_name}')
-                raise ValueError("No masks found")
-            
-            estimated_diameter = diams if isinstance(diams, (int, float)) else diams[0]
-            print(f'Estimated diameter for {self.image_name}: {estimated_diameter}')
-
-            outlines = utils.outlines_list(masks)
-            if not outlines:
-                print(f"No outlines found for {self.image_name}")
-                raise ValueError("No outlines found")
-            
-            # Save the ROI file
-            io.save_rois(masks, os.path.join(self.save_dir, self.image_name.replace('.tiff', '')))
-
-            # Print GPU usage after processing each image
-            self._print_gpu_usage()
-
-            return [self.image_path, estimated_diameter, processing_time], masks
+            return self._save_segmentation(masks, diams, processing_time), masks
         except Exception as e:
             print(f"Error processing {self.image_name}: {e}")
-            # Create a more substantial dummy mask
-            dummy_mask = self._create_dummy_mask(self.image.shape)
+            self._save_dummy_mask()
 
-            # Save the dummy mask as in ROI file
-            try:
-                io.save_rois(dummy_mask, os.path.join(self.save_dir, self.image_name.replace('.tiff', '')))
-            except Exception as save_e:
-                print(f"Error saving dummy mask for {self.image_name}: {save_e}")
-
-            self._print_gpu_usage()
+    @staticmethod
+    def _append_processing_row(file_path, row):
+        """Appends one row to processing_data.csv."""
+        with open(file_path, mode='a', newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(row)
 
     def _update_data_processing_file(self, cur_diameter_data):
-        with open(self.data_processing_file_path, mode='a', newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(cur_diameter_data)
-            f.close()
+        self._append_processing_row(self.data_processing_file_path, cur_diameter_data)
+
+    def _save_measurements(self, masks):
+        """Measures every cell in all channels and saves the table next to the ROIs, skipped when measure is 0."""
+        if not self.cellpose_config.get("measure", 1):
+            return
+        image = self.image
+        while image.ndim > 3:
+            image = image[0]  # first timepoint or Z slice, as segmented
+        measurements = measure_labels(image, masks, pixel_size_um=read_pixel_size(self.image_path))
+        measurements.insert(0, "Image", self.image_name)
+        measurements.to_csv(os.path.join(self.save_dir, self.image_name.replace('.tiff', '_measurements.csv')), index=False)
+
+    def _get_seg_channel_image(self):
+        """YX image of the segmentation channel, the mean of all channels when Cellpose segments in greyscale."""
+        image = self.image
+        while image.ndim > 3:
+            image = image[0]  # first timepoint or Z slice
+        if image.ndim == 2:
+            return image
+        if self.seg_ch[0] == 0:
+            return np.mean(image, axis=0, dtype=np.float32)
+        return image[self.seg_ch[0] - 1]
 
     def _save_mask_image(self, masks):
-        split_image = np.split(self.image, self.image.shape[-3], axis=-3) # Split along the channel dimension regardless of shape of image
-        fig, ax = plt.subplots(figsize=(20,20))
-        ax.imshow(np.squeeze(split_image[self.seg_ch-1], -3), cmap='gray')
-        ax.imshow(masks, alpha=0.5, cmap='viridis')
-        ax.axis('off')
+        """Saves the masks blended over the segmentation channel, skipped when save_overlay is 0 in cellpose_config.json."""
+        if not self.cellpose_config.get("save_overlay", 1):
+            return
+        overlay = render_label_overlay(self._get_seg_channel_image(), masks,
+                                       max_size=self.cellpose_config.get("overlay_max_size", 2048))
 
-        plt.savefig(os.path.join(self.save_dir, self.image_name.replace('.tiff', '_masks.png')), bbox_inches='tight', dpi=300)
-        plt.close()
+        overlay_format = self.cellpose_config.get("overlay_format", "png").lower()
+        overlay_path = os.path.join(self.save_dir, self.image_name.replace('.tiff', f'_masks.{overlay_format}'))
+        Image.fromarray(overlay).save(overlay_path, quality=90)
 
-    def process(self):  
+    def segment(self):
+        """Segments the image, saves its ROIs and mask image, and returns its processing_data.csv row."""
         self.save_dir = create_directory(os.path.join(self.well_path, "cellpose"))
 
         try:
             cur_diameter_data, masks = self._cellpose_segmentation()
         except Exception as e:
             print(f"Error segmenting image {self.image_path}: {e}")
+            return None
+        try:
+            self._save_mask_image(masks)
+        except Exception as e:
+            print(f"Error saving masks image for {self.image_path}: {e}")
+        try:
+            self._save_measurements(masks)
+        except Exception as e:
+            print(f"Error measuring cells of {self.image_path}: {e}")
+
+        # Tiled segmentations leave a raw label memmap, it is only removed once no view of it is left
+        raw_labels_path = masks.filename if isinstance(masks, np.memmap) else None
+        del masks
+        if raw_labels_path is not None:
+            try:
+                os.remove(raw_labels_path)
+            except OSError as e:
+                print(f"Could not remove {raw_labels_path}: {e}")
+        return cur_diameter_data
+
+    def process(self):
+        cur_diameter_data = self.segment()
         try:
             self._update_data_processing_file(cur_diameter_data)
         except Exception as e:
             print(f"Error saving data processing file {self.data_processing_file_path}: {e}")
+        return cur_diameter_data
+
+    @classmethod
+    def process_batch(cls, images, image_paths, diameter=None):
+        """Segments several images with a single model.eval call, then saves masks, ROIs and CSV rows per image.
+
+        FOVs of one shape are stacked so Cellpose batches the network tiles across images. When the
+        diameter is estimated they are passed as a list, as the size model runs per image.
+        """
+        processors = [cls(image, image_path, diameter) for image, image_path in zip(images, image_paths)]
+        for processor in processors:
+            processor.save_dir = create_directory(os.path.join(processor.well_path, "cellpose"))
+        first = processors[0]
+
+        same_shape = all(np.shape(image) == np.shape(images[0]) for image in images) and np.ndim(images[0]) == 3
         try:
-            self._save_mask_image(masks)
+            print(f"Processing {len(processors)} images in one Cellpose batch")
+            start_time = time.time()
+            if same_shape and first.cellpose_config['diameter']:
+                # (N, C, Y, X), each Z slice of the stack is segmented as its own 2D image
+                masks_list, diams = first._run_cellpose(np.stack(images, axis=0), channel_axis=1, z_axis=0)
+            else:
+                masks_list, diams = first._run_cellpose([np.asarray(image) for image in images])
+            batch_time = time.time() - start_time
+            print(f'Processing time for the batch of {len(processors)} images: {batch_time}')
         except Exception as e:
-            print(f"Error saving masks image for {self.image_path}: {e}")
+            print(f"Error processing batch, segmenting the images one by one: {e}")
+            for processor in processors:
+                processor.process()
+            return processors
+
+        diams_list = diams if np.ndim(diams) else [diams] * len(processors)
+        for processor, masks, diameter in zip(processors, masks_list, diams_list):
+            try:
+                processor._update_data_processing_file(processor._save_segmentation(masks, float(diameter), batch_time / len(processors),
+                                                                                    len(processors)))
+                processor._save_mask_image(masks)
+                processor._save_measurements(masks)
+            except Exception as e:
+                print(f"Error processing {processor.image_name}: {e}")
+                processor._save_dummy_mask()
+        return processors
+
+    @staticmethod
+    def _get_cpu_workers(config, num_images):
+        """(workers, torch threads per worker) for CPU segmentation, a single worker when a GPU is available.
+
+        cpu_workers 0 picks one worker per 4 cores, cpu_threads 0 splits the cores evenly between the workers.
+        """
+        if CellposeSingleton.gpu_available():
+            return 1, 0
+        num_cores = os.cpu_count() or 1
+        num_workers = min(config.get("cpu_workers", 0) or max(1, num_cores // 4), num_images)
+        num_threads = config.get("cpu_threads", 0) or max(1, num_cores // max(num_workers, 1))
+        return num_workers, num_threads
+
+    @classmethod
+    def process_parallel(cls, image_paths, num_workers, num_threads, diameter=None):
+        """Segments the images on a pool of CPU worker processes, each with its own model and torch thread budget.
+
+        The workers reopen the images from disk, memory-mapped when possible, so only the paths are sent to them.
+        The processing_data.csv rows are written here as the images complete, and returned.
+        """
+        print(f"Segmenting {len(image_paths)} images on {num_workers} CPU workers with {num_threads} threads each")
+        rows = []
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_cpu_worker, initargs=(num_threads,)) as executor:
+            futures = {executor.submit(_segment_image_path, image_path, diameter): image_path for image_path in image_paths}
+            for future in as_completed(futures):
+                try:
+                    cur_diameter_data = future.result()
+                    if cur_diameter_data is not None:
+                        # The worker created processing_data.csv with its header
+                        measurement_path = cls._get_well_path(futures[future], cls.WELL_PATTERN)[1]
+                        cls._append_processing_row(os.path.join(measurement_path, "processing_data.csv"), cur_diameter_data)
+                    rows.append(cur_diameter_data)
+                except Exception as e:
+                    print(f"Error processing {futures[future]}: {e}")
+        return rows
+
+    @staticmethod
+    def _is_stitched(image_path):
+        return os.path.basename(os.path.dirname(image_path)) == "stitching"
+
+    @classmethod
+    def _calibrate_diameter(cls, config, image_paths, mmap=True, remaining_wells=1):
+        """Segments sample FOVs with the size model until the plate's diameter is fixed.
+
+        Each well adds its share of the missing samples, remaining_wells being this and the later wells
+        of the plate, spread over its FOVs. Stitched images are only sampled when the well has no FOVs.
+        The sample runs on the CPU worker pool when there is one. Returns the image paths still to
+        segment and the calibrated diameter, None while the plate's sample is incomplete.
+        """
+        measurement_path = cls._get_well_path(image_paths[0], cls.WELL_PATTERN)[1]
+        cache = HiConADiameterCache(measurement_path, config["diameter_calibration"])
+        key = cache.get_key(config)
+
+        missing = cache.missing_samples(key)
+        if missing:
+            candidates = [image_path for image_path in image_paths if not cls._is_stitched(image_path)] or image_paths
+            num_samples = min(-(-missing // max(1, remaining_wells)), len(candidates))
+            sample = [candidates[i] for i in sorted(set(np.linspace(0, len(candidates) - 1, num_samples).round().astype(int).tolist()))]
+            print(f"Estimating the Cellpose diameter on {len(sample)} sample images")
+            num_workers, num_threads = cls._get_cpu_workers(config, len(sample))
+            if num_workers > 1:
+                rows = cls.process_parallel(sample, num_workers, num_threads)
+            else:
+                rows = [cls(read_image(image_path, mmap=mmap), image_path).process() for image_path in sample]
+            cache.add(key, [row[1] for row in rows if row is not None])
+            image_paths = [image_path for image_path in image_paths if image_path not in sample]
+        return image_paths, cache.get(key)
+
+    @classmethod
+    def process_images(cls, image_paths, mmap=True, remaining_wells=1):
+        """Segments the images one by one, or in batches of fov_batch images (0 for all of them) from cellpose_config.json.
+
+        Without a GPU the images are spread over cpu_workers processes instead, which read them from disk
+        themselves. With diameter 0 and diameter_calibration N, the diameter is estimated on N FOVs
+        spread over the wells of the plate and fixed for the others.
+        """
+        config = cls._load_cellpose_config() or {}
+        diameter = None
+        if not config.get("diameter") and config.get("diameter_calibration", 0) and image_paths:
+            image_paths, diameter = cls._calibrate_diameter(config, image_paths, mmap, remaining_wells)
+            if not image_paths:
+                return
+
+        num_workers, num_threads = cls._get_cpu_workers(config, len(image_paths))
+        if num_workers > 1:
+            cls.process_parallel(image_paths, num_workers, num_threads, diameter)
+            return
+
+        fov_batch = config.get("fov_batch", 1) or len(image_paths)
+        tile_size = config.get("tile_size", 0)
+        for start in range(0, len(image_paths), fov_batch):
+            # Only the images of one batch are open at a time, memory-mapped when possible
+            batch_paths = image_paths[start:start + fov_batch]
+            images = [read_image(image_path, mmap=mmap) for image_path in batch_paths]
+            if len(images) == 1 or (tile_size and any(max(np.shape(image)[-2:]) > tile_size for image in images)):
+                # Images larger than a tile are segmented one by one, block by block
+                for image, image_path in zip(images, batch_paths):
+                    cls(image, image_path, diameter).process()
+            else:
+                cls.process_batch(images, batch_paths, diameter)
+            del images
 
     def get_image(self):
         return self.image
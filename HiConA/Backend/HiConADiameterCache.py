@@ -0,0 +1,60 @@
+import json
+import os
+
+import numpy as np
+
+
+class HiConADiameterCache:
+    """Cellpose diameters of a plate, estimated on a sample of FOVs per model and channel and reused for all other images.
+
+    The diameters estimated on the first sample_fovs images of a plate are kept, their median is the
+    fixed diameter of every later image, so the size model only runs on the sample.
+    """
+    CACHE_FILE_NAME = "diameter_cache.json"
+
+    def __init__(self, measurement_path, sample_fovs=8):
+        self.cache_file = os.path.join(measurement_path, self.CACHE_FILE_NAME)
+        self.sample_fovs = max(1, int(sample_fovs))
+        self.records = self._load()
+
+    @staticmethod
+    def get_key(cellpose_config):
+        return f"{cellpose_config['model']}_ch{cellpose_config['channel1']}_{cellpose_config['channel2']}"
+
+    def _load(self):
+        if not os.path.isfile(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file, "r") as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def _save(self):
+        temp_file = self.cache_file + ".tmp"
+        try:
+            with open(temp_file, "w") as f:
+                json.dump(self.records, f)
+            os.replace(temp_file, self.cache_file)
+        except OSError as e:
+            print(f"Could not write diameter cache {self.cache_file}: {e}")
+
+    def missing_samples(self, key):
+        """Number of FOVs that still have to be sampled before the diameter is fixed."""
+        return max(0, self.sample_fovs - len(self.records.get(key, {}).get("samples", [])))
+
+    def get(self, key):
+        """Median of the sampled diameters, None while the sample is incomplete."""
+        if self.missing_samples(key) > 0:
+            return None
+        return self.records[key]["diameter"]
+
+    def add(self, key, diameters):
+        """Adds estimated diameters to the sample, failed estimates (0 or NaN) are dropped."""
+        record = self.records.setdefault(key, {"samples": [], "diameter": None})
+        record["samples"] += [float(d) for d in diameters if d is not None and np.isfinite(d) and d > 0]
+        if record["samples"]:
+            record["diameter"] = float(np.median(record["samples"]))
+        self._save()
+        if self.get(key) is not None:
+            print(f"Cellpose diameter for {key} fixed at {record['diameter']:.1f} px from {len(record['samples'])} FOVs")
@@ -8,8 +8,10 @@ from pathlib import Path
 import os
 from tkinter.filedialog import askdirectory
 import json
+from cellpose import io
 
 from HiConA.Backend.ImageJ_singleton import ImageJSingleton
+from HiConA.Utilities.IOread import load_label_image
 
 class HiConAImageJProcessor:
     def __init__(self, images, image_path):
@@ -49,6 +51,18 @@ class HiConAImageJProcessor:
             
         return None
 
+    def _rois_from_label_image(self):
+        """Writes the Cellpose ROI zip of the image from its label image when mask_output only saved the label image,
+        so macros that open the ROIs, e.g. MeasureCellposeSegmentation.ijm, work with every mask output."""
+        base_path = os.path.join(self.well_path, "cellpose", Path(self.image_path).stem)
+        if os.path.isfile(base_path + "_rois.zip"):
+            return
+        for labels_path in (base_path + "_labels.tiff", base_path + "_labels_rle.npz"):
+            if os.path.isfile(labels_path):
+                print(f"Writing ROIs of {labels_path} for the ImageJ macro")
+                io.save_rois(load_label_image(labels_path), base_path)
+                return
+
     def _imagej_run_macro(self):
         pre_macro_temp = os.path.join(self.temp_dir.name, "pre.tiff")
 
@@ -104,6 +118,7 @@ class HiConAImageJProcessor:
         """Processes the image based on flags for specific operations."""
         if self.config_var["show_UI"] == 1:
             ImageJSingleton.show_ui(True)
+        self._rois_from_label_image()
         self._imagej_run_macro()
         ImageJSingleton.show_ui(False)
         return self  # Return self to allow method chaining
@@ -0,0 +1,227 @@
+import importlib.util
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def _count_per_label(values, num_labels, weights=None):
+    return np.bincount(values.ravel(), weights=None if weights is None else weights.ravel(), minlength=num_labels + 1)
+
+
+def _unit_sides(own, other, width):
+    """Pixel edges between own and other that are a whole outline side of the own label, i.e. the
+    same boundary does not continue on either side. own and other hold one padded column per side."""
+    boundary = own[:, 1:width + 1] != other[:, 1:width + 1]
+    unit = boundary.copy()
+    for shift in (0, 2):
+        neighbour = own[:, shift:shift + width]
+        unit &= ~((neighbour == own[:, 1:width + 1]) & (other[:, shift:shift + width] != own[:, 1:width + 1]))
+    return np.pad(boundary, ((0, 0), (1, 1))), np.pad(unit, ((0, 0), (1, 1)))
+
+
+def _perimeter_counts(block, num_labels, last=False):
+    """Pixel edges, outline corners, unit-length outline sides and vertices joining two unit sides per
+    label in a block of label rows.
+
+    The first and last rows of the block are halos shared with the neighbouring blocks. Edges between
+    rows and the corners on them are counted from the top halo down, those with the bottom halo only
+    in the last block, so nothing is counted twice.
+    """
+    block = np.pad(block, ((0, 0), (1, 1)))
+    height, width = len(block) - 2, block.shape[1] - 2
+    counts = np.zeros((4, num_labels + 1))  # edges, corners, unit sides, unit side pairs
+
+    # Edges between vertically adjacent pixels, for the label below and the one above
+    horizontal, unit_below = _unit_sides(block[1:], block[:-1], width)
+    _, unit_above = _unit_sides(block[:-1], block[1:], width)
+    counted = slice(0, height + last)
+    for own, unit in ((block[1:], unit_below), (block[:-1], unit_above)):
+        counts[0] += _count_per_label(own[counted][horizontal[counted]], num_labels)
+        counts[2] += _count_per_label(own[counted][unit[counted]], num_labels)
+
+    # Edges between horizontally adjacent pixels of the block's own rows, an edge continues up or down
+    rows, above, below = block[1:-1], block[:-2], block[2:]
+    left, right = rows[:, :-1], rows[:, 1:]
+    vertical = left != right
+    for own, other, side in ((left, right, slice(0, -1)), (right, left, slice(1, None))):
+        other_side = slice(1, None) if side.start == 0 else slice(0, -1)
+        continues = ((above[:, side] == own) & (above[:, other_side] != own)) | \
+                    ((below[:, side] == own) & (below[:, other_side] != own))
+        unit = vertical & ~continues
+        counts[0] += _count_per_label(own[vertical], num_labels)
+        counts[2] += _count_per_label(own[unit], num_labels)
+        # The rows above and below the unit side hold the sides it turns into at its ends, along
+        # the own pixel when the pixel beyond it is not the own label, else along the other pixel
+        for beyond, straight, turned in ((above, unit_below[:height], unit_above[:height]),
+                                         (below, unit_above[1:], unit_below[1:])):
+            end_unit = np.where(beyond[:, side] != own, straight[:, side], turned[:, other_side])
+            counts[3] += _count_per_label(own[unit & end_unit], num_labels)
+
+    # Every 2x2 window is a vertex of the pixel grid, a label covering 1 or 3 of its pixels has an outline corner there
+    top, bottom = block[:-1][counted], block[1:][counted]
+    windows = (top[:, :-1], top[:, 1:], bottom[:, :-1], bottom[:, 1:])
+    a, b, c, d = windows
+    for k, label in enumerate(windows):
+        covered = sum((other == label).astype(np.int8) for other in windows)
+        # Each label is counted once per window, at its first position
+        first = np.ones(label.shape, dtype=bool)
+        for other in windows[:k]:
+            first &= other != label
+        diagonal = (covered == 2) & (((a == label) & (d == label)) | ((b == label) & (c == label)))
+        counts[1] += _count_per_label(label[first & ((covered == 1) | (covered == 3))], num_labels)
+        counts[1] += 2 * _count_per_label(label[first & diagonal], num_labels)
+
+    counts[:, 0] = 0
+    return counts
+
+
+def measure_labels(image, labels, pixel_size_um=1.0, chunk_rows=1024):
+    """Per-label measurements of a (C, Y, X) or (Y, X) image, the columns of ImageJ's
+    "area mean standard modal min perimeter shape" measurements, one row per label and channel.
+
+    Everything is accumulated with np.bincount over blocks of chunk_rows rows, so memmapped images
+    and labels of stitched wells are read once without loading them whole. The perimeter follows
+    ImageJ's traced outlines, pixel edges minus 2 - sqrt 2 per corner, where ImageJ only counts every
+    other corner of a staircase of unit steps. Shape descriptors come from the ellipse with the same
+    second moments, scaled to the area of the label as in ImageJ.
+
+    Returns:
+    pd.DataFrame: Label, Channel, Area, Mean, StdDev, Mode, Min, Max, X, Y, Perim., Circ., AR, Round,
+    lengths and areas in um.
+    """
+    if image.ndim == 2:
+        image = image[np.newaxis]
+    num_channels = image.shape[0]
+    height, width = labels.shape
+    num_labels = int(np.max(labels))
+    # The mode is taken of 8 and 16-bit images, (label, value) pairs then fit one int64 key
+    mode_image = image.dtype.kind == 'u' and image.dtype.itemsize <= 2
+    value_range = int(np.iinfo(image.dtype).max) + 1 if mode_image else None
+
+    area = np.zeros(num_labels + 1)
+    moments = np.zeros((5, num_labels + 1))  # sums of x, y, x^2, y^2, xy
+    sums = np.zeros((num_channels, num_labels + 1))
+    squares = np.zeros((num_channels, num_labels + 1))
+    minima = np.full((num_channels, num_labels + 1), np.inf)
+    maxima = np.full((num_channels, num_labels + 1), -np.inf)
+    mode_pairs = [[] for _ in range(num_channels)]
+    outline_counts = np.zeros((4, num_labels + 1))
+    index = np.arange(1, num_labels + 1)
+
+    xs = np.arange(width, dtype=np.float64)
+    for y0 in range(0, height, chunk_rows):
+        y1 = min(y0 + chunk_rows, height)
+        chunk = np.asarray(labels[y0:y1]).astype(np.int64)
+
+        # One halo row above and below, background beyond the image edges
+        above = np.asarray(labels[y0 - 1:y0]).astype(np.int64) if y0 > 0 else np.zeros((1, width), np.int64)
+        below = np.asarray(labels[y1:y1 + 1]).astype(np.int64) if y1 < height else np.zeros((1, width), np.int64)
+        outline_counts += _perimeter_counts(np.concatenate([above, chunk, below]), num_labels, last=y1 == height)
+
+        foreground = chunk > 0
+        chunk_labels = chunk[foreground]
+        y, x = np.nonzero(foreground)
+        x, y = xs[x], (y + y0).astype(np.float64)
+        area += _count_per_label(chunk_labels, num_labels)
+        for m, w in enumerate((x, y, x * x, y * y, x * y)):
+            moments[m] += _count_per_label(chunk_labels, num_labels, w)
+
+        for ch in range(num_channels):
+            values = np.asarray(image[ch, y0:y1])
+            fg_values = values[foreground]
+            as_float = fg_values.astype(np.float64)
+            sums[ch] += _count_per_label(chunk_labels, num_labels, as_float)
+            squares[ch] += _count_per_label(chunk_labels, num_labels, as_float * as_float)
+            # One sort by label, then value, gives min, max and the value counts of every label
+            if mode_image:
+                keys = np.sort(chunk_labels * value_range + fg_values)
+                sorted_labels, sorted_values = np.divmod(keys, value_range)
+            else:
+                order = np.lexsort((fg_values, chunk_labels))
+                sorted_labels, sorted_values = chunk_labels[order], fg_values[order]
+            if len(sorted_labels) == 0:
+                continue
+            group_starts = np.flatnonzero(np.diff(sorted_labels, prepend=-1))
+            group_ends = np.append(group_starts[1:], len(sorted_labels)) - 1
+            present = sorted_labels[group_starts]
+            minima[ch, present] = np.minimum(minima[ch, present], sorted_values[group_starts])
+            maxima[ch, present] = np.maximum(maxima[ch, present], sorted_values[group_ends])
+            if mode_image:
+                # (label, value) pairs with their counts, reduced across the blocks at the end
+                key_starts = np.flatnonzero(np.diff(keys, prepend=-1))
+                mode_pairs[ch].append((keys[key_starts], np.diff(np.append(key_starts, len(keys)))))
+
+    area = area[1:]
+    edges, corners, unit_sides, unit_pairs = outline_counts[:, 1:]
+    measured = area > 0
+    safe_area = np.maximum(area, 1)
+
+    # Ellipse with the same second moments, 1/12 for the extent of a pixel as in ImageJ
+    mean_x, mean_y = moments[0, 1:] / safe_area, moments[1, 1:] / safe_area
+    var_x = moments[2, 1:] / safe_area - mean_x ** 2 + 1 / 12
+    var_y = moments[3, 1:] / safe_area - mean_y ** 2 + 1 / 12
+    cov_xy = moments[4, 1:] / safe_area - mean_x * mean_y
+    spread = np.sqrt(((var_x - var_y) / 2) ** 2 + cov_xy ** 2)
+    major = np.sqrt((var_x + var_y) / 2 + spread)
+    minor = np.sqrt(np.maximum((var_x + var_y) / 2 - spread, 1e-12))
+    # Scaled as ImageJ's EllipseFitter so the ellipse has the area of the label, pi * major * minor / 4 = area
+    scale = np.sqrt(area / (np.pi * major * minor / 4))
+    major, minor = major * scale, minor * scale
+
+    # ImageJ counts the corner after every side longer than a pixel and every other corner along a run of
+    # unit sides, taking floor(k / 2) for a run of k as (k - 1) / 2 leaves out half a corner per even run
+    imagej_corners = corners - unit_sides + unit_pairs / 2
+    perimeter = edges - imagej_corners * (2 - np.sqrt(2))
+    shape_columns = {
+        "Area": area * pixel_size_um ** 2,
+        "X": (mean_x + 0.5) * pixel_size_um,
+        "Y": (mean_y + 0.5) * pixel_size_um,
+        "Perim.": perimeter * pixel_size_um,
+        "Circ.": np.minimum(4 * np.pi * area / np.maximum(perimeter, 1e-12) ** 2, 1),
+        "AR": major / minor,
+        "Round": 4 * area / (np.pi * major ** 2),
+    }
+
+    tables = []
+    for ch in range(num_channels):
+        mean = sums[ch, 1:] / safe_area
+        variance = (squares[ch, 1:] - area * mean ** 2) / np.maximum(area - 1, 1)
+        mode = np.full(num_labels, np.nan)
+        if mode_image and mode_pairs[ch]:
+            keys, inverse = np.unique(np.concatenate([k for k, _ in mode_pairs[ch]]), return_inverse=True)
+            counts = np.bincount(inverse, weights=np.concatenate([c for _, c in mode_pairs[ch]]))
+            pair_labels, pair_values = np.divmod(keys, value_range)
+            # Sort by label, count and falling value, the last pair of each label holds its most frequent value,
+            # the lowest one on ties as in ImageJ
+            order = np.lexsort((-pair_values, counts, pair_labels))
+            last = np.append(pair_labels[order][1:] != pair_labels[order][:-1], True)
+            mode[pair_labels[order][last] - 1] = pair_values[order][last]
+
+        table = pd.DataFrame({"Label": index, "Channel": ch + 1, "Area": shape_columns["Area"],
+                              "Mean": mean, "StdDev": np.sqrt(np.maximum(variance, 0)), "Mode": mode,
+                              "Min": minima[ch, 1:], "Max": maxima[ch, 1:]})
+        for column in ("X", "Y", "Perim.", "Circ.", "AR", "Round"):
+            table[column] = shape_columns[column]
+        tables.append(table[measured])
+    return pd.concat(tables, ignore_index=True)
+
+
+def concatenate_measurements(table_paths, output_path):
+    """Concatenates per-image measurement CSVs into one plate table, Parquet when pyarrow is installed, else CSV.
+
+    Returns:
+    str: path of the written table, None without tables.
+    """
+    tables = [pd.read_csv(path) for path in table_paths if os.path.isfile(path)]
+    if not tables:
+        return None
+    plate_table = pd.concat(tables, ignore_index=True)
+    if importlib.util.find_spec("pyarrow") is not None:
+        output_path = os.path.splitext(output_path)[0] + ".parquet"
+        plate_table.to_parquet(output_path, index=False)
+    else:
+        output_path = os.path.splitext(output_path)[0] + ".csv"
+        plate_table.to_csv(output_path, index=False)
+    print(f"Saved {len(plate_table)} measurements of {len(tables)} images to {output_path}")
+    return output_path
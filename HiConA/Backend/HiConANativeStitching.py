@@ -0,0 +1,380 @@
+import numpy as np
+import os
+import json
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from scipy import fft
+
+from HiConA.Utilities.ConfigReader_XML import XMLConfigReader
+from HiConA.Utilities.IOread import read_image, create_image_memmap
+
+
+def phase_correlation(image_a, image_b):
+    """
+    Integer shift e such that image_b[k] matches image_a[k + e], from the FFT cross-power spectrum.
+
+    Returns:
+    tuple: (shift_y, shift_x)
+    """
+    window = np.outer(np.hanning(image_a.shape[0]), np.hanning(image_a.shape[1])).astype(np.float32)
+    fa = fft.rfft2((image_a - image_a.mean()) * window, workers=-1)
+    fb = fft.rfft2((image_b - image_b.mean()) * window, workers=-1)
+    cross_power = fa * np.conj(fb)
+    cross_power /= np.abs(cross_power) + 1e-12
+    correlation = fft.irfft2(cross_power, s=image_a.shape, workers=-1)
+
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    # Peaks past the middle wrap around to negative shifts
+    return tuple(int(p) if p <= n // 2 else int(p) - n for p, n in zip(peak, correlation.shape))
+
+
+def normalised_cross_correlation(image_a, image_b, shift):
+    """NCC of the region where image_b[k] and image_a[k + shift] overlap."""
+    slices_a, slices_b = [], []
+    for e, n in zip(shift, image_a.shape):
+        if abs(e) >= n:
+            return 0.0
+        slices_a.append(slice(max(0, e), min(n, n + e)))
+        slices_b.append(slice(max(0, -e), min(n, n - e)))
+    a = image_a[tuple(slices_a)].astype(np.float64)
+    b = image_b[tuple(slices_b)].astype(np.float64)
+    a -= a.mean()
+    b -= b.mean()
+    denominator = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / denominator) if denominator > 0 else 0.0
+
+
+def linear_blending_weights(tile_shape):
+    """Weights falling off linearly towards the tile edges, as Fiji's Linear Blending."""
+    wy = np.minimum(np.arange(1, tile_shape[0] + 1), np.arange(tile_shape[0], 0, -1)).astype(np.float32)
+    wx = np.minimum(np.arange(1, tile_shape[1] + 1), np.arange(tile_shape[1], 0, -1)).astype(np.float32)
+    return np.outer(wy, wx)
+
+
+def get_overlap_regions(tile_i, tile_j, offset):
+    """Overlapping regions of two tiles when tile j sits at offset (y, x) from tile i, as float32."""
+    tile_shape = np.array(tile_i.shape)
+    start_i = np.maximum(offset, 0)
+    start_j = np.maximum(-offset, 0)
+    size = tile_shape - np.abs(offset)
+    region_i = tile_i[start_i[0]:start_i[0]+size[0], start_i[1]:start_i[1]+size[1]].astype(np.float32)
+    region_j = tile_j[start_j[0]:start_j[0]+size[0], start_j[1]:start_j[1]+size[1]].astype(np.float32)
+    return region_i, region_j
+
+
+def check_positions(ref_tiles, positions, min_correlation=0.30, num_pairs=4, min_overlap=16):
+    """Quick check of known tile positions: NCC of the largest overlaps at those positions, no FFT.
+
+    Returns:
+    bool: True if every checked overlap reaches min_correlation, a single shifted tile is enough to fail.
+    """
+    overlaps = []
+    for i in range(len(positions)):
+        for j in range(i + 1, len(positions)):
+            if ref_tiles[i] is None or ref_tiles[j] is None:
+                continue
+            offset = np.round(positions[j] - positions[i]).astype(int)
+            overlap = np.array(ref_tiles[i].shape) - np.abs(offset)
+            if np.all(overlap >= min_overlap):
+                overlaps.append((int(np.prod(overlap)), i, j, offset))
+    if not overlaps:
+        return True  # Nothing overlaps, so there is nothing to register either
+
+    overlaps.sort(key=lambda overlap: overlap[0], reverse=True)
+    correlations = [normalised_cross_correlation(*get_overlap_regions(ref_tiles[i], ref_tiles[j], offset), (0, 0))
+                    for _, i, j, offset in overlaps[:num_pairs]]
+    return min(correlations) >= min_correlation
+
+
+def load_well_tiles(well_path, well_name, num_fields):
+    """(..., C, Y, X) tile of every field from the files written by the preprocessing, None for missing fields.
+
+    The saved hyperstacks are memory-mapped, so only the rows that are fused are read. Wells without
+    saved hyperstacks are rebuilt from the chN folders.
+    """
+    ch_directories = sorted([d for d in os.listdir(well_path) if os.path.isdir(os.path.join(well_path, d)) and re.fullmatch(r"ch\d+", d)],
+                            key=lambda d: int(d[2:]))
+    tiles = []
+    for i in range(num_fields):
+        field_name = f"{well_name}_f{str(i+1).zfill(2)}"
+        hyperstack_paths = [os.path.join(well_path, f"{field_name}_{suffix}.tiff") for suffix in ("hyperstack", "timelapse_hyperstack")]
+        hyperstack_path = next((path for path in hyperstack_paths if os.path.isfile(path)), None)
+        if hyperstack_path is not None:
+            tiles.append(read_image(hyperstack_path))
+            continue
+
+        tile_paths = [os.path.join(well_path, ch_dir, f"{field_name}.tiff") for ch_dir in ch_directories]
+        if tile_paths and all(os.path.isfile(tile_path) for tile_path in tile_paths):
+            tiles.append(np.stack([np.squeeze(read_image(tile_path)) for tile_path in tile_paths], axis=0))
+        else:
+            tiles.append(None)
+    return tiles
+
+
+def get_reference_tiles(tiles, axes, ref_ch, ref_timepoint=1):
+    """2D reference channel of every tile that the registration runs on, one timepoint and Z stacks maximum projected."""
+    ref_tiles = []
+    for tile in tiles:
+        if tile is None:
+            ref_tiles.append(None)
+            continue
+        ref_tile = tile[..., ref_ch - 1, :, :]
+        if "T" in axes:
+            ref_tile = ref_tile[min(ref_timepoint, ref_tile.shape[0]) - 1]
+        if ref_tile.ndim == 3:
+            ref_tile = np.max(ref_tile, axis=0)
+        ref_tiles.append(ref_tile)
+    return ref_tiles
+
+
+def get_fused_shape(tiles, positions):
+    """(C, Y, X) shape of the canvas the tiles are fused into."""
+    num_channels, tile_h, tile_w = next(t for t in tiles if t is not None).shape[-3:]
+    offsets = np.round(positions - positions.min(axis=0)).astype(int)
+    return (num_channels, *(int(n) for n in offsets.max(axis=0) + np.array((tile_h, tile_w))))
+
+
+def fuse_tiles(tiles, positions, out=None, memory_mb=None):
+    """Linear blending of (C, Y, X) tiles at (y, x) pixel positions into one (C, Y, X) canvas.
+
+    The blending weights are shared by all channels, so every tile is read and added once. With
+    memory_mb the canvas is blended in row bands of about that size, each band only reading the
+    rows of the tiles that overlap it, so out can be a memmap much larger than RAM.
+    """
+    first_tile = next(t for t in tiles if t is not None)
+    num_channels, tile_h, tile_w = first_tile.shape
+    offsets = np.round(positions - positions.min(axis=0)).astype(int)
+    canvas_shape = get_fused_shape(tiles, positions)
+    height, width = canvas_shape[1:]
+    if out is None:
+        out = np.empty(canvas_shape, dtype=first_tile.dtype)
+
+    # float32 sums of all channels plus the weight sum, and as much again for the tile products
+    row_bytes = width * (num_channels + 1) * 4 * 2
+    band_rows = max(1, int(memory_mb * 2**20 // row_bytes)) if memory_mb else height
+
+    weights = linear_blending_weights((tile_h, tile_w))
+    integer_output = np.issubdtype(out.dtype, np.integer)
+    for y0 in range(0, height, band_rows):
+        y1 = min(height, y0 + band_rows)
+        fused = np.zeros((num_channels, y1 - y0, width), dtype=np.float32)
+        weight_sum = np.zeros((y1 - y0, width), dtype=np.float32)
+        for tile, (y, x) in zip(tiles, offsets):
+            if tile is None:
+                continue
+            top, bottom = max(y0, y), min(y1, y + tile_h)
+            if top >= bottom:
+                continue
+            tile_weights = weights[top-y:bottom-y]
+            fused[:, top-y0:bottom-y0, x:x+tile_w] += tile[:, top-y:bottom-y] * tile_weights
+            weight_sum[top-y0:bottom-y0, x:x+tile_w] += tile_weights
+
+        np.divide(fused, weight_sum, out=fused, where=weight_sum > 0)
+        if integer_output:
+            np.round(fused, out=fused)
+            np.clip(fused, np.iinfo(out.dtype).min, np.iinfo(out.dtype).max, out=fused)
+        out[:, y0:y1] = fused
+    return out
+
+
+def fuse_well(tiles, positions, xml_reader, output_path=None, memory_mb=0, axes="CYX"):
+    """Fuses in memory when the canvas fits in memory_mb, otherwise band by band straight into a memory-mapped TIFF at output_path.
+
+    Tiles with timepoints or planes in front of CYX are fused one (C, Y, X) image at a time into the
+    output file, so memory holds a single fused timepoint rather than the whole movie. Without
+    output_path a well larger than memory_mb is fused into a temporary TIFF, which the caller removes.
+
+    Returns:
+    tuple: (fused image, path it was written to or None)
+    """
+    first_tile = next(t for t in tiles if t is not None)
+    leading_shape = first_tile.shape[:-3]
+    fused_shape = (*leading_shape, *get_fused_shape(tiles, positions))
+    dtype = first_tile.dtype
+    fused_mb = np.prod(fused_shape) * (4 + dtype.itemsize) / 2**20
+    out_of_core = bool(memory_mb) and fused_mb > memory_mb
+    if out_of_core and output_path is None:
+        fd, output_path = tempfile.mkstemp(prefix="hicona_fused_", suffix=".tiff")
+        os.close(fd)
+    if not leading_shape and not out_of_core:
+        return fuse_tiles(tiles, positions), None
+
+    if output_path is None:
+        out = np.empty(fused_shape, dtype=dtype)
+    else:
+        print(f"Fusing {fused_shape} out of core into {output_path}")
+        out = create_image_memmap(output_path, fused_shape, dtype, xml_reader.get_pixel_scale(), axes, xml_reader.get_channel_order())
+    for index in np.ndindex(*leading_shape):
+        fuse_tiles([t[index] if t is not None else None for t in tiles], positions, out=out[index], memory_mb=memory_mb)
+        if output_path is not None:
+            out.flush()
+    return out, output_path
+
+
+class HiConANativeStitching:
+    """Stitches a well in Python: XML stage positions, phase correlation refinement, global least squares, linear blending."""
+    def __init__(self, stitching_dir): # stitching_dir to include path to well to process, XML_reader
+        self.saved_variables = self._load_variables()
+
+        self.ref_ch = self.saved_variables["stitch_ref_ch"]
+        self.ref_timepoint = self.saved_variables.get("stitch_ref_timepoint", 1)
+        self.well_path = stitching_dir["well_output_dir"]
+        self.well_name = os.path.basename(os.path.normpath(self.well_path))
+        self.xml_reader = stitching_dir["xml_reader"]
+        self.fov_images = stitching_dir.get("fov_images")  # {fov: (C, Y, X)} kept in memory by the preprocessing
+        self.output_path = stitching_dir.get("output_path")
+        self.registration_cache = stitching_dir.get("registration_cache")
+        self.axes = stitching_dir.get("axes", "CYX")
+        self.saved_path = None
+
+        # Same defaults as the Fiji Grid/Collection stitching macro
+        self.regression_threshold = self.saved_variables.get("stitch_regression_threshold", 0.30)
+        self.max_avg_displacement = self.saved_variables.get("stitch_max_avg_displacement", 2.50)
+        self.absolute_displacement = self.saved_variables.get("stitch_absolute_displacement", 3.50)
+        self.min_overlap = self.saved_variables.get("stitch_min_overlap", 16)  # pixels
+        self.max_workers = self.saved_variables.get("stitch_workers") or os.cpu_count()
+        self.memory_mb = self.saved_variables.get("stitch_memory_mb", 0)  # Larger wells are fused out of core
+
+        self.image_array = None
+
+    def _load_variables(self):
+        saved_variables_f = os.path.join(os.path.dirname(__file__), '..', 'GUI', "processing_variables.json")
+        if os.path.isfile(saved_variables_f):
+            with open(saved_variables_f, "r+") as f:
+                saved_var = json.load(f)
+                return saved_var
+        else:
+            return None
+
+    # --- Tile positions ---
+    def _get_nominal_positions(self):
+        """(y, x) pixel position of every field from the XML stage coordinates, same convention as the TileConfiguration."""
+        pixel_size = self.xml_reader.get_pixel_scale()
+        fields = self.xml_reader.get_well_layout()[self.well_name]
+        positions = np.array([[-y / pixel_size, x / pixel_size] for x, y in fields]) # y inverted as for ImageJ Stitching
+        return positions - positions.min(axis=0)
+
+    def _get_tiles(self):
+        """(C, Y, X) tile of every field, from memory when the preprocessing passed them on, else from the chN folders."""
+        num_fields = len(self.xml_reader.get_well_layout()[self.well_name])
+        if self.fov_images:
+            return [self.fov_images.get(i + 1) for i in range(num_fields)]
+        return load_well_tiles(self.well_path, self.well_name, num_fields)
+
+    # --- Registration ---
+    def _find_overlapping_pairs(self, positions, tile_shape, present):
+        pairs = []
+        for i in range(len(positions)):
+            for j in range(i + 1, len(positions)):
+                if not (present[i] and present[j]):
+                    continue
+                overlap = tile_shape - np.abs(np.round(positions[j] - positions[i]))
+                if np.all(overlap >= self.min_overlap):
+                    pairs.append((i, j))
+        return pairs
+
+    def _register_pair(self, tiles, positions, i, j):
+        """Refines the offset of tile j relative to tile i on their nominal overlap."""
+        nominal = np.round(positions[j] - positions[i]).astype(int)
+        region_i, region_j = get_overlap_regions(tiles[i], tiles[j], nominal)
+
+        shift = phase_correlation(region_i, region_j)
+        quality = normalised_cross_correlation(region_i, region_j, shift)
+        return i, j, nominal + np.array(shift), quality
+
+    def _register_tiles(self, tiles, positions):
+        """Pairwise phase correlation of all overlapping neighbours, returns the links that pass the correlation threshold."""
+        present = [t is not None for t in tiles]
+        tile_shape = np.array(next(t for t in tiles if t is not None).shape)
+        pairs = self._find_overlapping_pairs(positions, tile_shape, present)
+
+        # scipy.fft releases the GIL, so the pairs are registered in parallel
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(lambda pair: self._register_pair(tiles, positions, *pair), pairs))
+
+        links = []
+        for i, j, offset, quality in results:
+            if quality >= self.regression_threshold:
+                links.append((i, j, offset, quality))
+            else:
+                print(f"{self.well_name}: discarding link f{i+1}-f{j+1}, correlation {quality:.2f}")
+        return links
+
+    def _solve_global_positions(self, positions, links):
+        """Least-squares positions agreeing with all pairwise offsets, dropping the worst link while residuals are too large."""
+        links = list(links)
+        num_tiles = len(positions)
+        prior_weight = 1e-3  # Keeps unlinked tiles at their stage position and fixes the global offset
+
+        while True:
+            rows, targets, weights = [], [], []
+            for i, j, offset, quality in links:
+                row = np.zeros(num_tiles)
+                row[j], row[i] = 1, -1
+                rows.append(row)
+                targets.append(offset)
+                weights.append(quality)
+            for i in range(num_tiles):
+                row = np.zeros(num_tiles)
+                row[i] = 1
+                rows.append(row)
+                targets.append(positions[i])
+                weights.append(prior_weight)
+
+            sqrt_w = np.sqrt(np.array(weights))[:, np.newaxis]
+            solved = np.linalg.lstsq(np.array(rows) * sqrt_w, np.array(targets) * sqrt_w, rcond=None)[0]
+
+            if not links:
+                return solved
+            residuals = np.array([np.linalg.norm((solved[j] - solved[i]) - offset) for i, j, offset, _ in links])
+            worst = int(np.argmax(residuals))
+            if residuals[worst] <= self.absolute_displacement or residuals[worst] <= self.max_avg_displacement * max(residuals.mean(), 1e-9):
+                return solved
+            i, j = links[worst][:2]
+            print(f"{self.well_name}: removing link f{i+1}-f{j+1}, residual {residuals[worst]:.2f} px")
+            links.pop(worst)
+
+    def _stitch_well(self):
+        positions = self._get_nominal_positions()
+        tiles = self._get_tiles()
+
+        # Registered once on the reference channel and timepoint, the offsets are shared by all channels and timepoints
+        ref_tiles = get_reference_tiles(tiles, self.axes, self.ref_ch, self.ref_timepoint)
+        cached_positions = self.registration_cache.lookup(self.well_name, ref_tiles) if self.registration_cache else None
+        if cached_positions is not None:
+            positions = cached_positions
+        else:
+            links = self._register_tiles(ref_tiles, positions)
+            print(f"{self.well_name}: {len(links)} tile links used for the global optimisation")
+            positions = self._solve_global_positions(positions, links)
+            if self.registration_cache:
+                self.registration_cache.add(self.well_name, positions)
+
+        self.image_array, self.saved_path = fuse_well(tiles, positions, self.xml_reader, self.output_path, self.memory_mb, self.axes)
+
+    def process(self):
+        self._stitch_well()
+
+    def getImage(self):
+        return self.image_array
+
+    def getImagePath(self):
+        """Path the fused image was already written to, None if it is only in memory."""
+        return self.saved_path
+
+
+if __name__ == "__main__":
+    well_path = r"Z:\Emma\MMC poster\Processed\18112025_LS411N_ATX968_S9.6 - 1\r04c05"
+
+    xml_reader = XMLConfigReader(r"Z:\Emma\hs\bb41dbf0-41ce-4913-ac11-9a37ce70c088\bb41dbf0-41ce-4913-ac11.xml")
+
+    stitching_dir = {
+        "well_output_dir": well_path,
+        "xml_reader": xml_reader,
+        "output_path": os.path.join(well_path, "stitching", "r04c05.tiff")
+    }
+
+    stitcher = HiConANativeStitching(stitching_dir)
+    stitcher.process()
+    print(np.shape(stitcher.getImage()))
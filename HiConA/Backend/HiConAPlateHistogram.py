@@ -0,0 +1,80 @@
+import json
+import os
+
+import numpy as np
+
+
+class HiConAPlateHistogram:
+    """Per-channel 65536-bin intensity histograms accumulated over every FOV of a plate.
+
+    uint16 images are binned exactly. Other projections (e.g. Sum) can exceed 65535, the bin width of
+    a channel then doubles, merging pairs of bins, until its largest value fits.
+    """
+    NUM_BINS = np.iinfo(np.uint16).max + 1
+
+    def __init__(self, num_channels, subsample=4):
+        self.num_channels = num_channels
+        self.subsample = max(1, int(subsample))
+        self.histograms = np.zeros((num_channels, self.NUM_BINS), dtype=np.int64)
+        self.bin_widths = np.ones(num_channels, dtype=np.int64)
+
+    def _fit_range(self, ch, max_value):
+        """Doubles the bin width of a channel until max_value falls into its last bin."""
+        while max_value >= self.bin_widths[ch] * self.NUM_BINS:
+            merged = self.histograms[ch].reshape(-1, 2).sum(axis=1)
+            self.histograms[ch] = np.concatenate([merged, np.zeros(self.NUM_BINS - len(merged), dtype=np.int64)])
+            self.bin_widths[ch] *= 2
+
+    def add_image(self, image, channel_axis=-3, subsampled=False):
+        """Adds every (subsampled) pixel of one image to the histogram of its channel.
+
+        subsampled: the caller already subsampled the image, e.g. while reading it.
+        """
+        image = np.asarray(image)
+        step = 1 if subsampled else self.subsample
+        channels = np.moveaxis(image, channel_axis, 0) if image.ndim >= 3 else image[np.newaxis]
+        for ch, channel_image in enumerate(channels):
+            pixels = channel_image[..., ::step, ::step]
+            if pixels.dtype != np.uint16:
+                pixels = np.maximum(pixels, 0)
+                self._fit_range(ch, float(pixels.max()) if pixels.size else 0.0)
+                pixels = (pixels // self.bin_widths[ch]).astype(np.int64)
+            self.histograms[ch] += np.bincount(pixels.ravel(), minlength=self.NUM_BINS)
+        return self
+
+    def get_window(self, low_percentile=0.1, high_percentile=99.9):
+        """Per-channel (min, max) intensities at the given percentiles."""
+        mins, maxs = [], []
+        for histogram, bin_width in zip(self.histograms, self.bin_widths):
+            bin_width = int(bin_width)
+            total = histogram.sum()
+            if total == 0:
+                mins.append(0)
+                maxs.append(self.NUM_BINS * bin_width - 1)
+                continue
+            cumulative = np.cumsum(histogram)
+            # Lower edge of the low bin, upper edge of the high bin
+            mins.append(int(np.searchsorted(cumulative, total * low_percentile / 100, side="right")) * bin_width)
+            maxs.append((int(np.searchsorted(cumulative, total * high_percentile / 100)) + 1) * bin_width - 1)
+        return mins, maxs
+
+    def save(self, file_path, key):
+        """Saves the histograms together with the settings they were computed with."""
+        np.savez_compressed(file_path, histograms=self.histograms, bin_widths=self.bin_widths,
+                            key=json.dumps(key, sort_keys=True))
+
+    @classmethod
+    def load(cls, file_path, key):
+        """Returns the cached histograms, or None if missing or computed with different settings."""
+        if not os.path.isfile(file_path):
+            return None
+        with np.load(file_path) as cached:
+            # Caches from before the bin widths were stored hold clipped histograms
+            if str(cached["key"]) != json.dumps(key, sort_keys=True) or "bin_widths" not in cached.files:
+                return None
+            histograms = cached["histograms"]
+            bin_widths = cached["bin_widths"]
+        plate_histogram = cls(histograms.shape[0], key.get("subsample", 1))
+        plate_histogram.histograms = histograms
+        plate_histogram.bin_widths = bin_widths
+        return plate_histogram
@@ -0,0 +1,81 @@
+import re
+
+import numpy as np
+
+from HiConA.Utilities.Image_Utils import downsample_mean
+from HiConA.Utilities.IOread import save_images
+
+
+class HiConAPlateOverview:
+    """Low resolution montage of the whole plate, built from the FOVs while they are preprocessed.
+
+    Every FOV is block-mean downsampled and placed at its well (row, column) and field stage position,
+    so the overview never reopens any output file.
+    """
+    WELL_PATTERN = r'^r(\d+)c(\d+)$'
+
+    def __init__(self, xml_reader, well_names, downsample=16, well_spacing=8):
+        self.xml_reader = xml_reader
+        self.downsample = max(1, int(downsample))
+        self.well_spacing = well_spacing  # pixels between wells in the overview
+        self.well_layout = xml_reader.get_well_layout()
+
+        wells = {w: tuple(int(n) for n in re.match(self.WELL_PATTERN, w).groups()) for w in well_names}
+        self.well_positions = wells  # well -> (row, column) on the plate
+        self.first_row = min(row for row, _ in wells.values())
+        self.first_col = min(col for _, col in wells.values())
+        self.num_rows = max(row for row, _ in wells.values()) - self.first_row + 1
+        self.num_cols = max(col for _, col in wells.values()) - self.first_col + 1
+
+        self.field_offsets = None  # well -> (fields, 2) downsampled (y, x) pixel offsets inside the well
+        self.well_size = None
+        self.image_array = None
+
+    def _allocate(self, num_channels, tile_shape, dtype):
+        pixel_size = self.xml_reader.get_pixel_scale() * self.downsample
+        tile_h, tile_w = tile_shape[0] // self.downsample, tile_shape[1] // self.downsample
+
+        self.field_offsets = {}
+        well_extent = np.zeros(2)
+        for well in self.well_positions:
+            fields = np.array([[-y / pixel_size, x / pixel_size] for x, y in self.well_layout[well]]) # y inverted as for ImageJ Stitching
+            offsets = np.round(fields - fields.min(axis=0)).astype(int)
+            self.field_offsets[well] = offsets
+            well_extent = np.maximum(well_extent, offsets.max(axis=0) + (tile_h, tile_w))
+
+        self.well_size = well_extent.astype(int) + self.well_spacing
+        canvas_shape = (num_channels, self.num_rows * self.well_size[0], self.num_cols * self.well_size[1])
+        self.image_array = np.zeros(canvas_shape, dtype=dtype)
+
+    def add_fov(self, well, fov, image, axes="CYX"):
+        """Downsamples one preprocessed FOV and places it on the plate, the first timepoint and Z maximum are shown."""
+        if "T" in axes:
+            image = image[0]
+        if "Z" in axes:
+            image = np.max(image, axis=-4)
+        if "C" not in axes:
+            image = image[np.newaxis]
+
+        if self.image_array is None:
+            self._allocate(image.shape[0], image.shape[-2:], image.dtype)
+
+        small = downsample_mean(image, self.downsample)
+        if np.issubdtype(self.image_array.dtype, np.integer):
+            small = np.rint(small)
+
+        row, col = self.well_positions[well]
+        y = (row - self.first_row) * self.well_size[0] + self.field_offsets[well][fov - 1][0]
+        x = (col - self.first_col) * self.well_size[1] + self.field_offsets[well][fov - 1][1]
+        self.image_array[:, y:y+small.shape[1], x:x+small.shape[2]] = small
+        return self
+
+    def save(self, file_path):
+        if self.image_array is None:
+            return None
+        save_images(file_path, self.image_array, self.xml_reader.get_pixel_scale() * self.downsample, "CYX",
+                    self.xml_reader.get_channel_order())
+        print(f"Saved plate overview {self.image_array.shape} to {file_path}")
+        return file_path
+
+    def getImage(self):
+        return self.image_array
@@ -6,14 +6,16 @@ import tempfile
 import os
 import json
 
-from HiConA.Utilities.Image_Utils import get_xy_axis_from_image
+from HiConA.Utilities.Image_Utils import get_xy_axis_from_image, convert_to_8bit
 from HiConA.Utilities.ConfigReader import ConfigReader
 from HiConA.Utilities.IOread import load_images, save_images, create_directory
 from HiConA.Backend.ImageJ_singleton import ImageJSingleton
+from HiConA.Backend.HiConAZProjection import HiConAZProjector
+from HiConA.Backend.HiConAEDF import extended_depth_of_field
 
 class HiConAPreProcessor:
     def __init__(self, images, config):
-        self.image_array = np.array(images)
+        self.image_array = np.asarray(images)
         self.saved_variables = self._load_variables()
         # extract experimental information from config file
         self.image_y_dim, self.image_x_dim = get_xy_axis_from_image(images)
@@ -24,15 +26,19 @@ class HiConAPreProcessor:
         else:
             self.num_channels = 1
 
-    def process(self, projection, EDF_channel, to_8bit,):
+    def process(self, projection, EDF_channel, to_8bit, bit8_mode="full range", bit8_min=None, bit8_max=None, focus_metric="laplacian"):
         if projection == "Maximum":
             self._max_projection()
         elif projection == "Minimum":
             self._min_projection()
         elif projection == "ImageJ EDF":
             self._imagej_EDF(EDF_channel)
+        elif projection == "Native EDF":
+            self._native_EDF(EDF_channel)
+        elif projection in HiConAZProjector.STREAMING_PROJECTIONS:
+            self._z_projection(projection, focus_metric)
         if to_8bit:
-            self._convert_to_8bit()
+            self._convert_to_8bit(bit8_mode, bit8_min, bit8_max)
 
     def _max_projection(self):
         self.image_array = np.max(self.image_array, axis=0)
@@ -42,13 +48,15 @@ class HiConAPreProcessor:
         self.image_array = np.min(self.image_array, axis=0)
         return self
 
-    def _convert_to_8bit(self):
-        image_8bit = []
-        for image in self.image_array:
-            image_8bit.append(np.uint8((image / np.iinfo(np.uint16).max) * 255))
+    def _z_projection(self, projection, focus_metric="laplacian"):
+        """Mean, Sum, Standard Deviation and Best Focus projections of the loaded hyperstack."""
+        projector = HiConAZProjector(projection, self.num_channels, focus_metric=focus_metric)
+        self.image_array = projector.project_stack(self.image_array).get_image()
+        return self
 
-          # Stack the list back into a single numpy array
-        self.image_array = np.array(image_8bit)
+    def _convert_to_8bit(self, mode="full range", min_value=None, max_value=None):
+        # Channels are always the third last axis (ZCYX or CYX)
+        self.image_array = convert_to_8bit(self.image_array, mode=mode, min_value=min_value, max_value=max_value, channel_axis=-3)
         return self
 
     def _imagej_EDF(self, EDF_channel_num):
@@ -92,6 +100,20 @@ class HiConAPreProcessor:
         temp_dir.cleanup()
         return self
 
+    def _native_EDF(self, EDF_channel_num):
+        """In-process EDF of the EDF channel, the other channels are maximum projected as for ImageJ EDF."""
+        processed_image = np.empty((self.num_channels, self.image_y_dim, self.image_x_dim), dtype=self.image_array.dtype)
+        edf_channel = EDF_channel_num-1 # 0-indexed
+        for ch in range(self.num_channels):
+            cur_image = self.image_array[:,ch,:,:]
+            if ch == edf_channel:
+                processed_image[ch] = extended_depth_of_field(cur_image)
+            else:
+                processed_image[ch] = np.max(cur_image, axis=0)
+
+        self.image_array = processed_image
+        return self
+
     def _get_edf_macro(self):
     # EDF macro
         macro = """
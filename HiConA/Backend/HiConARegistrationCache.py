@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from HiConA.Backend.HiConANativeStitching import check_positions
+
+
+class HiConARegistrationCache:
+    """Registered tile positions of a plate, per well and per sublayout, so wells sharing a stage layout are not registered again.
+
+    Modes:
+    every well: every well is registered once, later runs on the same plate reuse its positions.
+    sample wells: only the first sample_wells wells of a sublayout are registered, the others use their median positions.
+    Reused positions must pass a quick correlation check, otherwise the well is registered in full.
+    Records keep the stitch backend that registered them, Fiji and Python positions are never mixed.
+    """
+    CACHE_FILE_NAME = "registration_cache.json"
+
+    def __init__(self, xml_reader, output_dir, mode="every well", sample_wells=3, min_correlation=0.30, backend="Fiji"):
+        self.cache_file = os.path.join(output_dir, self.CACHE_FILE_NAME)
+        self.mode = mode
+        self.backend = backend
+        self.sample_wells = max(1, int(sample_wells))
+        self.min_correlation = min_correlation
+
+        self.well_layout = xml_reader.get_well_layout()
+        self.well_sublayouts = xml_reader.get_well_sublayouts()
+        self.plate_key = self._get_plate_key(xml_reader)
+        self.records = self._load()
+
+    def _get_plate_key(self, xml_reader):
+        with open(xml_reader.file_path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def _get_layout_key(self, well_name):
+        """Sublayout and field positions of the well, positions are only reused between identical layouts."""
+        layout_hash = hashlib.sha1(json.dumps(self.well_layout[well_name]).encode()).hexdigest()[:16]
+        return f"{self.well_sublayouts.get(well_name, 0)}_{layout_hash}"
+
+    def _load(self):
+        records = {"plate": self.plate_key, "wells": {}}
+        if not os.path.isfile(self.cache_file):
+            return records
+        try:
+            with open(self.cache_file, "r") as f:
+                cached = json.load(f)
+        except ValueError:
+            return records
+        # A different XML means another plate or a changed layout, start again
+        return cached if cached.get("plate") == self.plate_key else records
+
+    def _save(self):
+        temp_file = self.cache_file + ".tmp"
+        try:
+            with open(temp_file, "w") as f:
+                json.dump(self.records, f)
+            os.replace(temp_file, self.cache_file)
+        except OSError as e:
+            print(f"Could not write registration cache {self.cache_file}: {e}")
+
+    def get(self, well_name):
+        """Cached (y, x) positions of the well, or the median of the registered sample wells of its sublayout."""
+        layout_key = self._get_layout_key(well_name)
+        record = self.records["wells"].get(well_name)
+        if record is not None and self._matches(record, layout_key):
+            return np.array(record["positions"])
+        if self.mode != "sample wells":
+            return None
+
+        samples = [np.array(r["positions"]) for r in self.records["wells"].values() if self._matches(r, layout_key)]
+        if len(samples) < self.sample_wells:
+            return None
+        return np.median(np.stack(samples, axis=0), axis=0)
+
+    def _matches(self, record, layout_key):
+        return record["layout"] == layout_key and record.get("backend") == self.backend
+
+    def lookup(self, well_name, ref_tiles):
+        """Reusable positions for the well that pass the correlation check on its reference channel tiles, else None."""
+        positions = self.get(well_name)
+        if positions is None or len(positions) != len(ref_tiles):
+            return None
+        if not check_positions(ref_tiles, positions, self.min_correlation):
+            print(f"{well_name}: cached tile positions failed the correlation check, registering again")
+            return None
+        print(f"{well_name}: reusing cached tile positions")
+        return positions
+
+    def add(self, well_name, positions):
+        self.records["wells"][well_name] = {"layout": self._get_layout_key(well_name),
+                                            "backend": self.backend,
+                                            "positions": np.asarray(positions).tolist()}
+        self._save()
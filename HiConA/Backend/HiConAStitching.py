@@ -1,25 +1,29 @@
 import numpy as np
 import os
-import scyjava
-from shutil import copy
+import re
 import json
 
 from HiConA.Utilities.ConfigReader_XML import XMLConfigReader
 from HiConA.Backend.ImageJ_singleton import ImageJSingleton
+from HiConA.Backend.HiConANativeStitching import fuse_well, get_reference_tiles, load_well_tiles
 
 class HiConAStitching:
     def __init__(self, stitching_dir): # stitching_dir to include path to well to process, XML_reader
         self.saved_variables = self._load_variables()
         
-        imagej_loc = self.saved_variables["imagej_loc"]
+        self.imagej_loc = self.saved_variables["imagej_loc"]
         
         self.ref_ch = self.saved_variables["stitch_ref_ch"]
         self.well_path = stitching_dir["well_output_dir"]
         self.well_name = os.path.basename(os.path.normpath(self.well_path))
         self.xml_reader = stitching_dir["xml_reader"]
-        
-        self._generate_TileConfiguration(self.xml_reader, self.well_path, self.well_name, self.ref_ch)
-        self.ij = ImageJSingleton.get_instance(imagej_loc)
+        self.fov_images = stitching_dir.get("fov_images")  # {fov: (C, Y, X)} kept in memory by the preprocessing
+        self.output_path = stitching_dir.get("output_path")
+        self.registration_cache = stitching_dir.get("registration_cache")
+        self.axes = stitching_dir.get("axes", "CYX")
+        self.ref_timepoint = self.saved_variables.get("stitch_ref_timepoint", 1)
+        self.memory_mb = self.saved_variables.get("stitch_memory_mb", 0)  # Larger wells are fused out of core
+        self.saved_path = None
 
     def _load_variables(self):
         saved_variables_f = os.path.join(os.path.dirname(__file__), '..', 'GUI', "processing_variables.json")
@@ -41,138 +45,56 @@ class HiConAStitching:
         if not os.path.exists(dir_path):
             os.makedirs(dir_path)
 
-    def _copy_tile_configure_files(self, ref_ch_dir, well_path, ch_directories):
-        stitch_configuration_files = [f for f in os.listdir(ref_ch_dir) if f.endswith(".txt")]
-
-        for ch_dir in ch_directories:
-            ch_path = os.path.join(well_path, ch_dir)
-
-            for config in stitch_configuration_files:
-                copy(os.path.join(ref_ch_dir, config), os.path.join(ch_path, config))
+    def _register_ref_channel(self, orgDir, wellName):
+        # Fiji only computes the tile positions and writes TileConfiguration_<well>.registered.txt, the fusion is done in Python
+        # The TileConfiguration and Fiji are only needed for wells the registration cache could not serve
+        self._generate_TileConfiguration(self.xml_reader, self.well_path, wellName, self.ref_ch)
+        ij = ImageJSingleton.get_instance(self.imagej_loc)
 
-    def _stitch_first_image(self, orgDir, saveDir, wellName, chName, pixelScale):
-    #In the macro, change where the bf.tiff is stored and where the processed_bf should be saved.
         macro = """
         //@ String orgDir
-        //@ String saveDir
         //@ String wellName
-        //@ String chName
-        //@ float scale
-
-        run("Grid/Collection stitching", "type=[Positions from file] order=[Defined by TileConfiguration] directory=["+orgDir+"] layout_file=TileConfiguration_"+wellName+".txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 compute_overlap computation_parameters=[Save memory (but be slower)] image_output=[Fuse and display]");
-        imageID = getImageID();
-        run("Set Scale...", "distance=1 known="+scale+" unit=um");
-        saveAs("Tiff", saveDir+File.separator+wellName+"_"+chName+".tiff");
-        selectImage(imageID);
-        """
-
-        args = {
-            'orgDir': orgDir,
-            'saveDir': saveDir,
-            'wellName': wellName,
-            'chName': chName,
-            'scale': pixelScale
-        }
-
-        self.ij.py.run_macro(macro, args)
-
-    def _stitch_remaining_image(self, orgDir, saveDir, wellName, chName, pixelScale):
-        #In the macro, change where the bf.tiff is stored and where the processed_bf should be saved.
-        macro = """
-        //@ String orgDir
-        //@ String saveDir
-        //@ String wellName
-        //@ String chName
-        //@ float scale
-
-        run("Grid/Collection stitching", "type=[Positions from file] order=[Defined by TileConfiguration] directory=["+orgDir+"] layout_file=TileConfiguration_"+wellName+".registered.txt fusion_method=[Linear Blending] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 subpixel_accuracy computation_parameters=[Save memory (but be slower)] image_output=[Fuse and display]");
-        run("Set Scale...", "distance=1 known="+scale+" unit=um");
-        saveAs("Tiff", saveDir+File.separator+wellName+"_"+chName+".tiff");
-        close("*");
-        """
-
-        args = {
-            'orgDir': orgDir,
-            'saveDir': saveDir,
-            'wellName': wellName,
-            'chName': chName,
-            'scale': pixelScale
-        }
 
-        self.ij.py.run_macro(macro, args)
-
-    
-    def _mergeImages(self, orgDir, wellName, pixelScale):
-        macro = """
-        //@ String orgDir
-        //@ String wellName
-        //@ float scale
-    
-        File.openSequence(orgDir, " open");
-        run("Images to Stack", "method=[Scale (smallest)] name="+wellName);
-
-        run("Re-order Hyperstack ...", "channels=[Slices (z)] slices=[Channels (c)] frames=[Frames (t)]");
-        imageID = getImageID();
-        run("Set Scale...", "distance=1 known="+scale+" unit=um");
-        saveAs("Tiff", orgDir+File.separator+wellName+".tiff");
-        selectImage(imageID);
+        run("Grid/Collection stitching", "type=[Positions from file] order=[Defined by TileConfiguration] directory=["+orgDir+"] layout_file=TileConfiguration_"+wellName+".txt fusion_method=[Do not fuse images (only write TileConfiguration)] regression_threshold=0.30 max/avg_displacement_threshold=2.50 absolute_displacement_threshold=3.50 compute_overlap subpixel_accuracy computation_parameters=[Save memory (but be slower)] image_output=[Fuse and display]");
         """
 
         args = {
             'orgDir': orgDir,
-            'wellName': wellName,
-            'scale': pixelScale
+            'wellName': wellName
         }
 
-        self.ij.py.run_macro(macro, args)
-
-    def _set_output_image(self):
-        WindowManager = scyjava.jimport('ij.WindowManager')
-        output_image = WindowManager.getCurrentImage()
-
-        #print(f"Output image type: {type(output_image)}")
-
-        if output_image is not None:
-            processed_image = self.ij.py.from_java(output_image)
-
-            if hasattr(processed_image, 'dims'):
-                #print(f"Dimension names: {processed_image.dims}")
-                desired_order = [d for d in ['T', 'Z', 'C', 'Y', 'X'] if d in processed_image.dims]
-                processed_image = processed_image.transpose(*desired_order)
-                processed_image = processed_image.values
+        ij.py.run_macro(macro, args)
 
-            #print(f"Array shape: {processed_image.shape}")
-
-            output_image.close()
-
-            necessary_type = np.uint16
-            min_value = np.iinfo(necessary_type).min # 0
-            max_value = np.iinfo(necessary_type).max # 65535
-            array_clipped = np.clip(processed_image, min_value, max_value)
-            self.image_array = array_clipped.astype(necessary_type)
+    def _read_registered_positions(self, ref_ch_dir, well_name, num_fields):
+        """(y, x) pixel position of every field from the registered TileConfiguration."""
+        positions = np.zeros((num_fields, 2))
+        tile_line = re.compile(r'^' + re.escape(well_name) + r'_f(\d+)\.tiff\s*;\s*;\s*\(\s*([-\d.eE+]+)\s*,\s*([-\d.eE+]+)')
+        with open(os.path.join(ref_ch_dir, f"TileConfiguration_{well_name}.registered.txt"), "r") as f:
+            for line in f:
+                match = tile_line.match(line.strip())
+                if match:
+                    positions[int(match.group(1)) - 1] = (float(match.group(3)), float(match.group(2)))
+        return positions
 
     def _stitch_well(self, xml_reader, well_path, well_name, ref_ch):
-        stitched_path = os.path.join(well_path, "stitching")
-        self._create_dir(stitched_path)
-
-        pixelScale = xml_reader.get_pixel_scale()
-
-        ch_directories = [d for d in os.listdir(well_path) if os.path.isdir(os.path.join(well_path, d)) and d.startswith("ch") and d != "ch"+str(ref_ch)]
+        num_fields = len(xml_reader.get_well_layout()[well_name])
         ref_ch_dir = os.path.join(well_path, "ch"+str(ref_ch))
 
-        self._stitch_first_image(ref_ch_dir, stitched_path, well_name, "ch"+str(ref_ch), pixelScale)
-
-        if len(ch_directories) != 0:
-            self._copy_tile_configure_files(ref_ch_dir, well_path, ch_directories)
-
-            for ch_dir in ch_directories:
-                ch_path = os.path.join(well_path, ch_dir)
-
-                self._stitch_remaining_image(ch_path, stitched_path, well_name, ch_dir, pixelScale)
+        if self.fov_images:
+            tiles = [self.fov_images.get(i + 1) for i in range(num_fields)]
+        else:
+            tiles = load_well_tiles(well_path, well_name, num_fields)
 
-            self._mergeImages(stitched_path, well_name, pixelScale)
+        ref_tiles = get_reference_tiles(tiles, self.axes, ref_ch, self.ref_timepoint)
+        positions = self.registration_cache.lookup(well_name, ref_tiles) if self.registration_cache else None
+        if positions is None:
+            self._register_ref_channel(ref_ch_dir, well_name)
+            positions = self._read_registered_positions(ref_ch_dir, well_name, num_fields)
+            if self.registration_cache:
+                self.registration_cache.add(well_name, positions)
 
-        self._set_output_image()
+        # All channels and timepoints are blended with the reference channel offsets
+        self.image_array, self.saved_path = fuse_well(tiles, positions, xml_reader, self.output_path, self.memory_mb, self.axes)
 
     def process(self):
         self._stitch_well(self.xml_reader, self.well_path, self.well_name, self.ref_ch)
@@ -180,6 +102,10 @@ class HiConAStitching:
     def getImage(self):
         return self.image_array
 
+    def getImagePath(self):
+        """Path the fused image was already written to, None if it is only in memory."""
+        return self.saved_path
+
 
 if __name__ == "__main__":
     well_path = r"Z:\Emma\MMC poster\Processed\18112025_LS411N_ATX968_S9.6 - 1\r04c05"
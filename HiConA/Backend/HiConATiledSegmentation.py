@@ -0,0 +1,123 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+
+def get_blocks(shape, block_size=2048, overlap=256):
+    """(y0, y1, x0, x1) of overlapping blocks covering a (Y, X) image in raster order."""
+    step = max(1, block_size - overlap)
+    height, width = shape
+    ys = list(range(0, max(height - overlap, 1), step))
+    xs = list(range(0, max(width - overlap, 1), step))
+    return [(y0, min(y0 + block_size, height), x0, min(x0 + block_size, width)) for y0 in ys for x0 in xs]
+
+
+def get_written_mask(block, merged_blocks):
+    """Mask of the pixels of block that earlier blocks have already written, labelled or background."""
+    y0, y1, x0, x1 = block
+    written = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+    for py0, py1, px0, px1 in merged_blocks:
+        top, bottom, left, right = max(y0, py0), min(y1, py1), max(x0, px0), min(x1, px1)
+        if top < bottom and left < right:
+            written[top - y0:bottom - y0, left - x0:right - x0] = True
+    return written
+
+
+def merge_block_labels(out, block_labels, y0, x0, written, next_label, iou_threshold=0.3):
+    """Writes the labels of one block into out, reusing the IDs of labels already written in the overlap.
+
+    written marks the pixels of the block that earlier blocks have written (see get_written_mask). A block
+    label takes the ID of the existing label it overlaps with an IoU of at least iou_threshold inside that
+    region, labels left with pixels to write get new IDs from next_label. Pixels already labelled are kept.
+
+    Returns:
+    int: next free label ID.
+    """
+    h, w = block_labels.shape
+    region = out[y0:y0+h, x0:x0+w]
+    existing = np.asarray(region)
+    block_labels = block_labels.astype(np.int64)
+
+    num_labels = int(block_labels.max())
+    if num_labels == 0:
+        return next_label
+    mapping = np.zeros(num_labels + 1, dtype=np.int64)
+
+    # IoU of every pair of labels that meet in the part of the block already written by earlier blocks,
+    # both areas are taken over the whole written region, background included
+    both = written & (existing > 0) & (block_labels > 0)
+    if np.any(both):
+        existing_ids = existing[both].astype(np.int64)
+        new_ids = block_labels[both]
+        pairs, intersection = np.unique(existing_ids * (num_labels + 1) + new_ids, return_counts=True)
+        pair_existing, pair_new = pairs // (num_labels + 1), pairs % (num_labels + 1)
+
+        existing_written = existing[written].astype(np.int64)
+        existing_ids, existing_area = np.unique(existing_written[existing_written > 0], return_counts=True)
+        new_area = np.bincount(block_labels[written].ravel(), minlength=num_labels + 1)
+        union = existing_area[np.searchsorted(existing_ids, pair_existing)] + new_area[pair_new] - intersection
+        iou = intersection / union
+
+        # Best match per block label
+        order = np.argsort(iou)
+        for e, n, score in zip(pair_existing[order], pair_new[order], iou[order]):
+            if score >= iou_threshold:
+                mapping[n] = e
+
+    write = (existing == 0) & (block_labels > 0)
+    # Only labels that still have pixels to write need a new ID
+    has_pixels = np.bincount(block_labels[write].ravel(), minlength=num_labels + 1) > 0
+    unmatched = np.flatnonzero((mapping[1:] == 0) & has_pixels[1:]) + 1
+    mapping[unmatched] = np.arange(next_label, next_label + len(unmatched))
+    next_label += len(unmatched)
+
+    region[write] = mapping[block_labels[write]]
+    return next_label
+
+
+def segment_tiled(image, segment_fn, out, block_size=2048, overlap=256, max_workers=0, iou_threshold=0.3):
+    """Segments a (C, Y, X) image block by block into the (Y, X) label image out, e.g. a memmap.
+
+    segment_fn(block) returns (labels, info) for a (C, h, w) block and must be picklable when
+    max_workers > 0, then the blocks are segmented on a process pool. Only the blocks in flight are
+    held in memory, the labels are merged across the seams in raster order.
+
+    Returns:
+    list: info of every block.
+    """
+    blocks = get_blocks(image.shape[-2:], block_size, overlap)
+    infos = []
+    merged_blocks = []
+    next_label = 1
+
+    def _merge(block, result):
+        nonlocal next_label
+        labels, info = result
+        written = get_written_mask(block, merged_blocks)
+        next_label = merge_block_labels(out, labels, block[0], block[2], written, next_label, iou_threshold)
+        merged_blocks.append(block)
+        infos.append(info)
+
+    if not max_workers:
+        for block in blocks:
+            y0, y1, x0, x1 = block
+            _merge(block, segment_fn(np.asarray(image[..., y0:y1, x0:x1])))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            for block in blocks:
+                y0, y1, x0, x1 = block
+                pending.append((block, executor.submit(segment_fn, np.asarray(image[..., y0:y1, x0:x1]))))
+                if len(pending) >= 2 * max_workers:
+                    _merge(*_pop_result(pending))
+            while pending:
+                _merge(*_pop_result(pending))
+
+    print(f"Segmented {len(blocks)} blocks, {next_label - 1} labels after merging")
+    return infos
+
+
+def _pop_result(pending):
+    block, future = pending.popleft()
+    return block, future.result()
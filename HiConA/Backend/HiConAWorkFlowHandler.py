@@ -4,12 +4,19 @@ import tifffile
 import re
 
 from HiConA.Utilities.ConfigReader import ConfigReader
-from HiConA.Utilities.IOread import load_images, save_images, create_directory
+from HiConA.Utilities.IOread import load_images, read_image, save_images, save_pyramidal_ome, create_directory
 from HiConA.Backend.HiConAPreProcessor import HiConAPreProcessor
+from HiConA.Backend.HiConAZProjection import HiConAZProjector
+from HiConA.Backend.HiConAEDF import extended_depth_of_field_many
+from HiConA.Backend.HiConAPlateHistogram import HiConAPlateHistogram
+from HiConA.Backend.HiConAPlateOverview import HiConAPlateOverview
 from HiConA.Backend.HiConAStitching import HiConAStitching
+from HiConA.Backend.HiConANativeStitching import HiConANativeStitching, get_reference_tiles
+from HiConA.Backend.HiConARegistrationCache import HiConARegistrationCache
 from HiConA.Utilities.Image_Utils import get_xy_axis_from_image
 from HiConA.Backend.HiConAImageJMacro import HiConAImageJProcessor
 from HiConA.Backend.HiConACellpose import HiConACellposeProcessor
+from HiConA.Backend.HiConAMeasurement import concatenate_measurements
 
 
 class HiConAWorkflowHandler:
@@ -28,24 +35,49 @@ class HiConAWorkflowHandler:
 
         self.output_dir = os.path.join(output_dir, self.measurement_name)
         self.axes = self._get_image_axes()
+        self.extra_projections = self._get_extra_projections()
+        self.plate_window = None
+        self.stitch_tiles = {}  # {fov: (C, Y, X)} of the current well, handed to the stitcher without a disk round trip
+        self.registration_cache = None
+        self.plate_overview = None
     # --- 2. Public Interface ---
 
     def run(self):
         """Starts the high-content imaging processing workflow."""
+        if self.processes_to_run.get("stitching", 0):
+            self.registration_cache = HiConARegistrationCache(self.xml_reader, create_directory(self.output_dir),
+                                                              mode=self.processes_to_run.get("stitch_registration", "every well"),
+                                                              sample_wells=self.processes_to_run.get("stitch_sample_wells", 3),
+                                                              backend=self.processes_to_run.get("stitch_backend", "Fiji"))
+        if self.run_preprocess and self._use_plate_scaling():
+            self.plate_window = self._get_plate_intensity_window()
+
+        if self.run_preprocess and self.processes_to_run.get("plate_overview", 0):
+            self.plate_overview = HiConAPlateOverview(self.xml_reader, self.files.well_names,
+                                                      downsample=self.processes_to_run.get("overview_downsample", 16))
+
         for cur_well in self.files.well_names:
             print("Processing well: " + cur_well)
             self._process_well(cur_well)
 
+        if self.plate_overview is not None:
+            self.plate_overview.save(os.path.join(create_directory(self.output_dir), f"{self.measurement_name}_overview.tiff"))
+
+        if self.processes_to_run.get("cellpose", 0) == 1:
+            self._save_plate_measurements()
+
     # --- 3. High-Level Flow Control (Well/Pipeline Management) ---
     def _process_well(self, cur_well):
         """Process a single well, including optional stitching and advanced processing."""
         well_output_dir = create_directory(os.path.join(self.output_dir, cur_well))
 
+        self.stitch_tiles = {}
         if self.run_preprocess:
             self._run_preprocessing_pipeline(cur_well, well_output_dir)
 
         if self.processes_to_run.get("stitching", 0):
             self._run_stitching_pipeline(cur_well, well_output_dir)
+            self.stitch_tiles = {}
 
         if self.processes_to_run.get("cellpose", 0) == 1:
             self._run_advanced_pipeline(cur_well, well_output_dir, "cellpose")
@@ -58,14 +90,31 @@ class HiConAWorkflowHandler:
         """Loop over FOVs and timepoints, preprocess, and save."""
         fov_list = self.files.get_well_fov_list(cur_well)
         timepoints = range(1, self.timepoints + 1) if self.timepoints > 1 else [None]
+        native_edf = self._iter_native_edf(cur_well, fov_list, timepoints)
 
         for fov in fov_list:
             images_to_stack = []
+            extra_projections_to_stack = {projection: [] for projection in self.extra_projections}
             for t in timepoints:
-                images = self._load_fov(cur_well, fov, t)
-                print(np.shape(images))
-                preprocessed = self._apply_preprocess(images)
+                if self._use_streaming_projection():
+                    # Planes are folded into the projection as they are read, the Z stack is never loaded
+                    projector = self._project_fov(cur_well, fov, t)
+                    preprocessed = self._apply_preprocess(projector.get_image(), projected=True)
+                elif native_edf is not None:
+                    # The EDF channel's planes are only read by the EDF pool
+                    preprocessed = self._apply_preprocess(self._project_native_edf_fov(cur_well, fov, t, next(native_edf)),
+                                                          projected=True)
+                else:
+                    images = self._load_fov(cur_well, fov, t)
+                    print(np.shape(images))
+                    preprocessed = self._apply_preprocess(images)
+                    if self.extra_projections:
+                        projector = HiConAZProjector(self.extra_projections, self.channels,
+                                                     focus_metric=self.processes_to_run.get("focus_metric", "laplacian"))
+                        projector.project_stack(self._prepare_hyperstack(images))
                 images_to_stack.append(preprocessed)
+                for projection in self.extra_projections:
+                    extra_projections_to_stack[projection].append(projector.get_image(projection))
 
             #print(np.shape(images_to_stack))
             # Stack multiple timepoints into a single hyperstack if needed
@@ -77,15 +126,49 @@ class HiConAWorkflowHandler:
                 suffix = "hyperstack"
             #print(np.shape(final_image), "final image shape")
 
-            # How do we handle multiple timepoints?
+            if self.plate_overview is not None:
+                self.plate_overview.add_fov(cur_well, fov, final_image, self.axes)
+
             if self.processes_to_run.get("stitching", 0):
-                self._save_split_ch_images(final_image, fov, cur_well, well_output_dir)
-            elif self.processes_to_run.get("sep_ch", 0):
+                self._keep_stitch_tile(fov, final_image)
+                if self.processes_to_run.get("stitch_backend", "Fiji") == "Fiji":
+                    # Fiji registers from the reference tiles on disk, everything else is fused from memory
+                    self._save_stitch_reference(final_image, fov, cur_well, well_output_dir)
+            if self.processes_to_run.get("sep_ch", 0):
                 self._save_split_ch_images(final_image, fov, cur_well, well_output_dir, include_channel_names=True)
 
             save_name = os.path.join(well_output_dir, f"{cur_well}_f{str(fov).zfill(2)}_{suffix}.tiff")
             self._save_fov(save_name, final_image)
 
+            self._save_extra_projections(extra_projections_to_stack, fov, cur_well, well_output_dir)
+
+    def _keep_stitch_tile(self, fov, image):
+        """Keeps the FOV in memory for the stitching while the well fits in stitch_memory_mb, otherwise the stitcher memory-maps the saved hyperstacks."""
+        if self.stitch_tiles is None:
+            return
+        self.stitch_tiles[fov] = image
+        memory_mb = self.processes_to_run.get("stitch_memory_mb", 0)
+        if memory_mb and sum(tile.nbytes for tile in self.stitch_tiles.values()) / 2**20 > memory_mb:
+            print(f"Tiles of the well exceed {memory_mb} MB, stitching from the saved hyperstacks")
+            self.stitch_tiles = None
+
+    def _save_stitch_reference(self, image, fov, cur_well, well_output_dir):
+        """Saves the 2D reference channel of the FOV to chN for Fiji, one timepoint and Z maximum projected."""
+        ref_ch = int(self.processes_to_run.get("stitch_ref_ch"))
+        ref_tile = get_reference_tiles([image], self.axes, ref_ch, self.processes_to_run.get("stitch_ref_timepoint", 1))[0]
+        ch_dir = create_directory(os.path.join(well_output_dir, f"ch{ref_ch}"))
+        save_name = os.path.join(ch_dir, f"{cur_well}_f{str(fov).zfill(2)}.tiff")
+        self._save_fov(save_name, ref_tile[np.newaxis], "CYX", channel_name=[self.xml_reader.get_channel_order()[ref_ch - 1]])
+
+    def _save_extra_projections(self, extra_projections, fov, cur_well, well_output_dir):
+        """Saves the additional projections computed in the same pass, one folder per projection."""
+        axes = self.axes.replace("Z", "")
+        for projection, images in extra_projections.items():
+            image = np.stack(images, axis=0) if len(images) > 1 else images[0]
+            proj_dir = create_directory(os.path.join(well_output_dir, "projections", projection.replace(" ", "_")))
+            save_name = os.path.join(proj_dir, f"{cur_well}_f{str(fov).zfill(2)}.tiff")
+            self._save_fov(save_name, image, axes)
+
     def _save_split_ch_images(self, image, fov, cur_well, well_output_dir, include_channel_names=False):
         """Loop over channels to save each channel individually. To be used for stitching and for split channels."""
         split_image = np.split(image, image.shape[-3], axis=-3) # Split along the channel dimension regardless of shape of image
@@ -101,7 +184,7 @@ class HiConAWorkflowHandler:
 
     def _check_preprocess_selected(self):
         """Helper function to just determine if any preprossing will be performed"""
-        processes = [self.processes_to_run.get('hyperstack'), self.processes_to_run.get('8bit'), self.processes_to_run.get('sep_ch')]#, self.processes_to_run.get("stitching") == 1]
+        processes = [self.processes_to_run.get('hyperstack'), self.processes_to_run.get('8bit'), self.processes_to_run.get('sep_ch'), self.processes_to_run.get('plate_overview')]#, self.processes_to_run.get("stitching") == 1]
         if any(p == 1 for p in processes) or self.processes_to_run.get('proj') != "None":
             return True
         else:
@@ -109,14 +192,40 @@ class HiConAWorkflowHandler:
     
     def _run_stitching_pipeline(self, cur_well, well_output_dir):
         """Perform stitching on all FOV in preprocessed well."""
+        stitched_dir = create_directory(os.path.join(well_output_dir, "stitching"))
+        stitched_path = os.path.join(stitched_dir, f"{cur_well}.tiff")
         stitching_dict = {"well_output_dir": well_output_dir,
-                          "xml_reader":self.xml_reader}
-        # How do we handle multiple timepoints?
-        stitching_processor = HiConAStitching(stitching_dict)
+                          "xml_reader":self.xml_reader,
+                          "fov_images": self.stitch_tiles,
+                          "output_path": stitched_path,
+                          "registration_cache": self.registration_cache,
+                          "axes": self.axes}
+        if self.processes_to_run.get("stitch_backend", "Fiji") == "Python":
+            stitching_processor = HiConANativeStitching(stitching_dict)
+        else:
+            stitching_processor = HiConAStitching(stitching_dict)
         stitching_processor.process()
-        stitched_image = stitching_processor.getImage()
-        #print(np.shape(stitched_image))
-        self._save_fov(os.path.join(well_output_dir, "stitching", f"{cur_well}.tiff"), stitched_image, "CYX")
+
+        if self._use_pyramidal_output():
+            save_pyramidal_ome(self._get_stitched_path(well_output_dir, cur_well), stitching_processor.getImage(),
+                               self.xml_reader.get_pixel_scale(), self.xml_reader.get_channel_order(), self.axes)
+            # A plain TIFF fused out of core was only needed as the source of the pyramid
+            saved_path = stitching_processor.getImagePath()
+            del stitching_processor
+            if saved_path is not None:
+                os.remove(saved_path)
+        # Wells too large for memory are fused straight into the output file
+        elif stitching_processor.getImagePath() is None:
+            self._save_fov(stitched_path, stitching_processor.getImage())
+
+    def _save_plate_measurements(self):
+        """Concatenates the per-image cell measurements of all wells into one plate table."""
+        table_paths = []
+        for cur_well in self.files.well_names:
+            cellpose_dir = os.path.join(self.output_dir, cur_well, "cellpose")
+            if os.path.isdir(cellpose_dir):
+                table_paths += [os.path.join(cellpose_dir, f) for f in sorted(os.listdir(cellpose_dir)) if f.endswith("_measurements.csv")]
+        concatenate_measurements(table_paths, os.path.join(self.output_dir, f"{self.measurement_name}_measurements"))
 
     def _run_advanced_pipeline(self, cur_well, well_output_dir, process):
         """Process stitched image or all fovs with user chosen ImageJ macro."""
@@ -127,40 +236,135 @@ class HiConAWorkflowHandler:
             save_dir = create_directory(os.path.join(well_output_dir, "imagej"))
             
         if self.processes_to_run.get("advanced_process_order") == "stitched image":
-            image_paths_to_process = [os.path.join(well_output_dir, "stitching", cur_well+".tiff")]
+            image_paths_to_process = [self._get_stitched_path(well_output_dir, cur_well)]
         elif self.processes_to_run.get("advanced_process_order") == "each FOV":
             image_paths_to_process = [os.path.join(well_output_dir, im) for im in os.listdir(well_output_dir) if im.endswith(".tiff")]
         elif self.processes_to_run.get("advanced_process_order") == "all available images":
-            image_paths_to_process = [os.path.join(well_output_dir, "stitching", cur_well+".tiff")] + [os.path.join(well_output_dir, im) for im in os.listdir(well_output_dir) if im.endswith(".tiff")]
+            image_paths_to_process = [self._get_stitched_path(well_output_dir, cur_well)] + [os.path.join(well_output_dir, im) for im in os.listdir(well_output_dir) if im.endswith(".tiff")]
         
+        if process == "cellpose":
+            # The diameter calibration sample is spread over this and the later wells
+            remaining_wells = len(self.files.well_names) - self.files.well_names.index(cur_well)
+            HiConACellposeProcessor.process_images(image_paths_to_process, mmap=self.processes_to_run.get("mmap", 1),
+                                                   remaining_wells=remaining_wells)
+            return
+
         processed_images = {}
 
         for image_path in image_paths_to_process:
-            image = np.array(tifffile.imread(image_path))
+            # Memory-mapped when possible so the hyperstack is not copied onto the heap
+            image = read_image(image_path, mmap=self.processes_to_run.get("mmap", 1))
             #print(image_path)
             #print(np.shape(image))
             
             processed = self._apply_advanced_processes(image, image_path, process)
             processed_images[image_path] = processed
         
-        if process != 'cellpose':
-            for image_path, analysed_image in processed_images.items():
-                image_name = os.path.basename(image_path).split(".")[0]
-                save_name = os.path.join(save_dir, f"{image_name}_analysed.tiff")
-                self._save_fov(save_name, analysed_image)
+        for image_path, analysed_image in processed_images.items():
+            image_name = os.path.basename(image_path).split(".")[0]
+            save_name = os.path.join(save_dir, f"{image_name}_analysed.tiff")
+            self._save_fov(save_name, analysed_image)
 
-    def _apply_preprocess(self, images):
+    def _iter_native_edf(self, cur_well, fov_list, timepoints):
+        """Native EDF of the EDF channel of every FOV and timepoint of the well, computed ahead on a process pool.
+
+        None for other projections, and with extra projections, which need the whole Z stack loaded anyway.
+        """
+        if self.processes_to_run.get("proj") != "Native EDF" or self.extra_projections:
+            return None
+        edf_channel = self.processes_to_run.get("EDF_channel") - 1
+        file_lists = (self.files.get_fov_images(cur_well, fov, t)[edf_channel::self.channels] for fov in fov_list for t in timepoints)
+        return extended_depth_of_field_many(file_lists, max_workers=self.processes_to_run.get("edf_workers") or None)
+
+    def _project_native_edf_fov(self, well_name, FOV, timepoint, edf_image):
+        """(C, Y, X) Native EDF of one FOV, the other channels are maximum projected from their own files."""
+        edf_channel = self.processes_to_run.get("EDF_channel") - 1
+        if self.channels == 1:
+            return np.asarray(edf_image)[np.newaxis]
+        projector = HiConAZProjector("Maximum", self.channels, mmap=bool(self.processes_to_run.get("mmap", 1)))
+        projector.project_files(self.files.get_fov_images(well_name, FOV, timepoint), skip_channels=(edf_channel,))
+        projected = projector.get_image()
+        projected[edf_channel] = edf_image
+        return projected
+
+    def _apply_preprocess(self, images, projected=False):
         """Normalize, project, or EDF the hyperstack before any further processing."""
-        hyperstack = self._prepare_hyperstack(images)
+        hyperstack = images if projected else self._prepare_hyperstack(images)
 
         processor = HiConAPreProcessor(hyperstack, self.config_file)
         processor.process(
-            projection=self.processes_to_run.get("proj"),
+            projection=None if projected else self.processes_to_run.get("proj"),
             EDF_channel=self.processes_to_run.get("EDF_channel"),
-            to_8bit=self.processes_to_run.get("8bit", False)
+            to_8bit=self.processes_to_run.get("8bit", False),
+            focus_metric=self.processes_to_run.get("focus_metric", "laplacian"),
+            **self._get_8bit_scaling()
         )
         return processor.get_image()
 
+    def _get_8bit_scaling(self):
+        """8-bit mode and window, the plate percentile window is applied as a fixed per-channel window."""
+        if self.plate_window is not None:
+            return {"bit8_mode": "fixed", "bit8_min": self.plate_window[0], "bit8_max": self.plate_window[1]}
+        return {"bit8_mode": self.processes_to_run.get("8bit_mode", "full range"),
+                "bit8_min": self.processes_to_run.get("8bit_min"),
+                "bit8_max": self.processes_to_run.get("8bit_max")}
+
+    # --- 4. Plate-wide intensity scaling ---
+    def _use_plate_scaling(self):
+        return bool(self.processes_to_run.get("8bit", 0)) and self.processes_to_run.get("8bit_mode") == "plate percentile"
+
+    def _get_plate_intensity_window(self):
+        """First pass: per-channel histograms over the whole plate, cached so only the percentiles can change without a re-read."""
+        subsample = self.processes_to_run.get("histogram_subsample", 4)
+        # The output dir is shared by every measurement of a plate, re-imaged plates must not reuse the histograms
+        key = {"measurement": self.config_file["GUID"],
+               "proj": self.processes_to_run.get("proj"),
+               "EDF_channel": self.processes_to_run.get("EDF_channel"),
+               "focus_metric": self.processes_to_run.get("focus_metric", "laplacian"),
+               "subsample": subsample,
+               "wells": self.files.well_names}
+        histogram_path = os.path.join(create_directory(self.output_dir), "plate_histograms.npz")
+
+        plate_histogram = HiConAPlateHistogram.load(histogram_path, key)
+        if plate_histogram is None:
+            print("Building plate intensity histograms")
+            plate_histogram = HiConAPlateHistogram(self.channels, subsample)
+            timepoints = range(1, self.timepoints + 1) if self.timepoints > 1 else [None]
+            for cur_well in self.files.well_names:
+                for fov in self.files.get_well_fov_list(cur_well):
+                    for t in timepoints:
+                        plate_histogram.add_image(self._get_histogram_image(cur_well, fov, t, subsample), subsampled=True)
+            plate_histogram.save(histogram_path, key)
+        else:
+            print(f"Using cached plate intensity histograms from {histogram_path}")
+
+        window = plate_histogram.get_window(self.processes_to_run.get("8bit_percentile_low", 0.1),
+                                            self.processes_to_run.get("8bit_percentile_high", 99.9))
+        print(f"Plate intensity window per channel: min {window[0]}, max {window[1]}")
+        return window
+
+    def _get_histogram_image(self, cur_well, fov, timepoint, subsample):
+        """Preprocessed (not yet 8-bit) image of one FOV, subsampled by subsample, during the read where possible."""
+        mmap = bool(self.processes_to_run.get("mmap", 1))
+        projection = self.processes_to_run.get("proj")
+        if self._use_streaming_projection():
+            # Pixel-wise projections of subsampled planes equal the subsampled projection. Best Focus scores
+            # whole planes, so its planes are read in full and the projection is subsampled instead.
+            read_step = 1 if projection == "Best Focus" else subsample
+            projector = HiConAZProjector(projection, self.channels, mmap=mmap,
+                                         focus_metric=self.processes_to_run.get("focus_metric", "laplacian"))
+            for index, fp in enumerate(self.files.get_fov_images(cur_well, fov, timepoint)):
+                projector.add_plane(index % self.channels, read_image(fp, mmap)[::read_step, ::read_step])
+            step = subsample // read_step
+            return projector.get_image()[..., ::step, ::step]
+
+        processor = HiConAPreProcessor(self._prepare_hyperstack(self._load_fov(cur_well, fov, timepoint)), self.config_file)
+        processor.process(projection=projection,
+                          EDF_channel=self.processes_to_run.get("EDF_channel"),
+                          to_8bit=False,
+                          focus_metric=self.processes_to_run.get("focus_metric", "laplacian"))
+        return processor.get_image()[..., ::subsample, ::subsample]
+
     def _apply_advanced_processes(self, hyperstack, image_path, process):
         """Run cellpose or ImageJ macro on selected image"""
         if process == "cellpose":
@@ -199,10 +403,39 @@ class HiConAWorkflowHandler:
                FOV (int): Field of view number
                timepoint (int, optional): Timepoint index. Defaults to None.
          """
-        image_pattern = self.files.build_imagename_pattern(FOV, timepoint)
-        print(f"Loading images for {well_name}, FOV {FOV}, Timepoint {timepoint if timepoint else 'N/A'} with pattern: {image_pattern}")
-        paths = self.files.get_opera_phenix_images_from_FOV(well_name, image_pattern)
-        return load_images(paths)
+        print(f"Loading images for {well_name}, FOV {FOV}, Timepoint {timepoint if timepoint else 'N/A'}")
+        paths = self.files.get_fov_images(well_name, FOV, timepoint)
+        return load_images(paths, max_workers=self.processes_to_run.get("io_workers"))
+
+    def _get_extra_projections(self):
+        """Additional projections (extra_proj in processing_variables.json) computed in the same pass as the main one."""
+        extra_projections = []
+        for projection in self.processes_to_run.get("extra_proj", []):
+            if projection not in HiConAZProjector.STREAMING_PROJECTIONS:
+                print(f"Skipping additional projection {projection}: only {', '.join(HiConAZProjector.STREAMING_PROJECTIONS)} are supported")
+            elif projection != self.processes_to_run.get("proj") and projection not in extra_projections:
+                extra_projections.append(projection)
+        return extra_projections
+
+    def _use_streaming_projection(self):
+        """Projections that can be folded plane by plane instead of loading the whole stack."""
+        return self.processes_to_run.get("proj") in HiConAZProjector.STREAMING_PROJECTIONS
+
+    def _use_pyramidal_output(self):
+        return self.processes_to_run.get("stitch_output", "ImageJ TIFF") == "Pyramidal OME-TIFF"
+
+    def _get_stitched_path(self, well_output_dir, cur_well):
+        extension = ".ome.tiff" if self._use_pyramidal_output() else ".tiff"
+        return os.path.join(well_output_dir, "stitching", cur_well + extension)
+
+    def _project_fov(self, well_name, FOV, timepoint=None):
+        """Streams the planes of one FOV through the projector, the main projection is the first one."""
+        print(f"Projecting images for {well_name}, FOV {FOV}, Timepoint {timepoint if timepoint else 'N/A'}")
+        paths = self.files.get_fov_images(well_name, FOV, timepoint)
+        projector = HiConAZProjector([self.processes_to_run.get("proj")] + self.extra_projections, self.channels,
+                                     mmap=bool(self.processes_to_run.get("mmap", 1)),
+                                     focus_metric=self.processes_to_run.get("focus_metric", "laplacian"))
+        return projector.project_files(paths)
 
     def _save_fov(self, full_path, image, image_axes = None, channel_name = None):
         pixel_size_um = self.xml_reader.get_pixel_scale()
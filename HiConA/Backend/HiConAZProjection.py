@@ -0,0 +1,141 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage
+
+from HiConA.Utilities.IOread import read_image
+
+
+def focus_measure(plane, method="laplacian"):
+    """Scalar sharpness of a plane, variance of the Laplacian or Brenner gradient."""
+    plane = np.asarray(plane, dtype=np.float32)
+    if method == "brenner":
+        diff = plane[:, 2:] - plane[:, :-2]
+        return float(np.mean(diff * diff))
+    return float(np.var(ndimage.laplace(plane)))
+
+
+class HiConAZProjector:
+    """Folds each Z plane into running per-channel projections while the planes are read,
+    so peak memory is one accumulator per channel and projection plus the planes in flight.
+    Several projections can be requested at once and still cost a single read."""
+    STREAMING_PROJECTIONS = ("Maximum", "Minimum", "Mean", "Sum", "Standard Deviation", "Best Focus")
+
+    def __init__(self, projections, num_channels, mmap=True, prefetch=2, focus_metric="laplacian"):
+        self.projections = [projections] if isinstance(projections, str) else list(projections)
+        for projection in self.projections:
+            if projection not in self.STREAMING_PROJECTIONS:
+                raise ValueError(f"Projection {projection} cannot be streamed")
+        self.num_channels = num_channels
+        self.mmap = mmap
+        self.prefetch = max(1, prefetch)
+        self.focus_metric = focus_metric
+
+        self.image_arrays = {}  # projection -> (C, Y, X), each channel is the accumulator for that channel
+        self.plane_count = [0] * num_channels
+        self.best_focus = [-np.inf] * num_channels
+        self._sum = None
+        self._sum_sq = None
+
+    def _allocate(self, plane):
+        shape = (self.num_channels, *plane.shape)
+        dtype = plane.dtype.newbyteorder('=')
+        # Zeroed so a channel that never gets a plane comes out black instead of uninitialised memory
+        for projection in ("Maximum", "Minimum", "Best Focus"):
+            if projection in self.projections:
+                self.image_arrays[projection] = np.zeros(shape, dtype=dtype)
+        # Mean, Sum and StdDev share float64 running sums so they cannot overflow the input type
+        if any(p in self.projections for p in ("Mean", "Sum", "Standard Deviation")):
+            self._sum = np.zeros(shape, dtype=np.float64)
+        if "Standard Deviation" in self.projections:
+            self._sum_sq = np.zeros(shape, dtype=np.float64)
+
+    def add_plane(self, channel, plane):
+        """Folds one (Y, X) plane into the accumulators of its channel in place."""
+        if not any(self.plane_count):
+            self._allocate(plane)
+        first_plane = self.plane_count[channel] == 0
+
+        for projection in ("Maximum", "Minimum"):
+            if projection not in self.image_arrays:
+                continue
+            acc = self.image_arrays[projection][channel]
+            if first_plane:
+                acc[...] = plane
+            elif projection == "Maximum":
+                np.maximum(acc, plane, out=acc)
+            else:
+                np.minimum(acc, plane, out=acc)
+
+        if self._sum is not None:
+            np.add(self._sum[channel], plane, out=self._sum[channel])
+        if self._sum_sq is not None:
+            self._sum_sq[channel] += np.square(plane, dtype=np.float64)
+
+        if "Best Focus" in self.image_arrays:
+            score = focus_measure(plane, self.focus_metric)
+            if score > self.best_focus[channel]:
+                self.best_focus[channel] = score
+                self.image_arrays["Best Focus"][channel] = plane
+
+        self.plane_count[channel] += 1
+        return self
+
+    def project_files(self, filepaths, skip_channels=()):
+        """Reads the planes of one FOV (sorted by plane then channel) and folds them one at a time.
+
+        The planes of skip_channels (0-indexed) are not read, e.g. a channel projected elsewhere.
+        """
+        start_time = time.perf_counter()
+        num_read = 0
+        # Read a couple of planes ahead so disk/network I/O overlaps with the folding
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            pending = deque()
+            for index, fp in enumerate(filepaths):
+                if index % self.num_channels in skip_channels:
+                    continue
+                pending.append((index, executor.submit(read_image, fp, self.mmap)))
+                num_read += 1
+                if len(pending) >= self.prefetch:
+                    self._fold_next(pending)
+            while pending:
+                self._fold_next(pending)
+
+        print(f"Projected {num_read} planes ({', '.join(self.projections)}) in {time.perf_counter() - start_time:.2f} s")
+        return self
+
+    def project_stack(self, hyperstack):
+        """Folds an already loaded (Z, C, Y, X) hyperstack."""
+        for plane in hyperstack:
+            for ch, channel_plane in enumerate(plane):
+                self.add_plane(ch, channel_plane)
+        return self
+
+    def _fold_next(self, pending):
+        index, future = pending.popleft()
+        self.add_plane(index % self.num_channels, future.result())
+
+    def get_image(self, projection=None):
+        """Returns the (C, Y, X) result of one projection, the first requested one by default."""
+        projection = projection or self.projections[0]
+        empty_channels = [ch for ch, count in enumerate(self.plane_count) if count == 0]
+        if empty_channels:
+            print(f"No planes were added for channels {empty_channels}, their {projection} projection is all zeros")
+        if projection in self.image_arrays:
+            return self.image_arrays[projection]
+
+        # Sum, Mean and StdDev are 32-bit float, as ImageJ's Z Project
+        if projection == "Sum":
+            return self._sum.astype(np.float32)
+        counts = np.maximum(np.array(self.plane_count, dtype=np.float64), 1).reshape(-1, 1, 1)
+        mean = self._sum / counts
+        if projection == "Mean":
+            return mean.astype(np.float32)
+        variance = np.maximum(self._sum_sq / counts - mean * mean, 0)
+        return np.sqrt(variance).astype(np.float32)
+
+    def get_images(self):
+        """Returns every requested projection as {projection: (C, Y, X)}."""
+        return {projection: self.get_image(projection) for projection in self.projections}
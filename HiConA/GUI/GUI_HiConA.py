@@ -6,14 +6,19 @@ from tkinter import Scrollbar, Canvas
 from tkinter.filedialog import askdirectory, askopenfilename
 import os
 import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 from HiConA.Utilities.ConfigReader import ConfigReader
 from HiConA.Utilities.ConfigReader_XML import XMLConfigReader
 from HiConA.Utilities.FileManagement import FilePathHandler
+from HiConA.Utilities.MeasurementCache import MeasurementCache
 
 class HiConAGUI:
     def __init__(self, window):
         self.master = window
+        self.scan_id = 0
+        self.scan_remaining = 0
         self._load_variables()
 
         self._initiate_window()
@@ -69,8 +74,8 @@ class HiConAGUI:
         self.output_button.grid(row=1, column=2, padx=10, pady=10)
 
         # Update button
-        self.confirm_button = tb.Button(source_frame, text="Update", command=self._update_selection)
-        self.confirm_button.grid(row=0, column=3, padx=10, pady=10, sticky=tk.E)
+        self.update_button = tb.Button(source_frame, text="Update", command=self._update_selection)
+        self.update_button.grid(row=0, column=3, padx=10, pady=10, sticky=tk.E)
 
 
         # Processing and Analysis selection
@@ -106,8 +111,12 @@ class HiConAGUI:
         # Processing options
         self.hyperstack_state = tk.IntVar()
         self.hyperstack_state.set(self._set_variable("hyperstack"))
+        self.overview_state = tk.IntVar()
+        self.overview_state.set(self._set_variable("plate_overview"))
         self.bit8_state = tk.IntVar()
         self.bit8_state.set(self._set_variable("8bit"))
+        self.bit8_mode_text = tk.StringVar()
+        self.bit8_mode_text.set(self._set_variable("8bit_mode") or "full range")
         self.sep_ch_state = tk.IntVar()
         self.sep_ch_state.set(self._set_variable("sep_ch"))
         self.proj_text = tk.StringVar()
@@ -118,6 +127,12 @@ class HiConAGUI:
         self.stitching_state.set(self._set_variable("stitching"))
         self.stitching_ch_int = tk.IntVar()
         self.stitching_ch_int.set(self._set_variable("stitch_ref_ch"))
+        self.stitch_backend_text = tk.StringVar()
+        self.stitch_backend_text.set(self._set_variable("stitch_backend") or "Fiji")
+        self.stitch_output_text = tk.StringVar()
+        self.stitch_output_text.set(self._set_variable("stitch_output") or "ImageJ TIFF")
+        self.stitch_registration_text = tk.StringVar()
+        self.stitch_registration_text.set(self._set_variable("stitch_registration") or "every well")
         self.imagej_entry_text = tk.StringVar()
         self.imagej_entry_text.set(self._set_variable("imagej_loc"))
 
@@ -125,22 +140,30 @@ class HiConAGUI:
                                                variable=self.hyperstack_state)
         self.hyperstack_check.grid(row=0, column=0, pady=5, sticky=tk.W)
 
+        self.overview_check = tb.Checkbutton(processing_frame, text = "Plate Overview",
+                                             variable=self.overview_state)
+        self.overview_check.grid(row=0, column=1, pady=5, sticky=tk.W)
+
         self.bit8_check = tb.Checkbutton(processing_frame, text = "Convert to 8-bit",
                                          variable=self.bit8_state)
         self.bit8_check.grid(row=1, column=0, pady=5, sticky=tk.W)
 
+        self.bit8_mode_combo = tb.Combobox(processing_frame, textvariable=self.bit8_mode_text, width=18,
+                                           state='readonly', values=["full range", "fixed", "per channel", "plate percentile"])
+        self.bit8_mode_combo.grid(row=1, column=1, pady=5, sticky=tk.W)
+
         self.sep_ch_check = tb.Checkbutton(processing_frame, text="Separate Channels          ",
                                            variable=self.sep_ch_state)
         self.sep_ch_check.grid(row=2, column=0, pady=5, sticky=tk.W)
 
         tb.Label(processing_frame, text="Projection Method").grid(row=3, column=0, pady=20, sticky=tk.W)
-        self.proj_combo = tb.Combobox(processing_frame, textvariable=self.proj_text, width=12,
-                                      state='readonly', values=["None", "Maximum", "Minimum", "ImageJ EDF"])
+        self.proj_combo = tb.Combobox(processing_frame, textvariable=self.proj_text, width=18,
+                                      state='readonly', values=["None", "Maximum", "Minimum", "Mean", "Sum", "Standard Deviation", "Best Focus", "Native EDF", "ImageJ EDF"])
         self.proj_combo.grid(row=3, column=1, pady=15, sticky=tk.W)
         self.proj_combo.bind("<<ComboboxSelected>>", self._show_hidden_frame_bind)
 
         self.edf_frame = tb.Frame(processing_frame)
-        tb.Label(self.edf_frame, text="Channel for ImageJ EDF").grid(row=0, column=0, pady=5, sticky=tk.W)
+        tb.Label(self.edf_frame, text="Channel for EDF").grid(row=0, column=0, pady=5, sticky=tk.W)
         self.edfproj_entry = tb.Entry(self.edf_frame, text=self.edf_ch_int, width=2, background="White", validate='key',
                                       validatecommand=(self.master.register(self._validate_int), '%P')).grid(row=0, column=1, padx=38, sticky=tk.W)
 
@@ -153,6 +176,19 @@ class HiConAGUI:
         tb.Label(self.stitching_frame, text="Channel for Stitching").grid(row=0, column=0, pady=5, sticky=tk.W)
         self.stitching_entry = tb.Entry(self.stitching_frame, text=self.stitching_ch_int, width=2, background="White", validate='key',
                                       validatecommand=(self.master.register(self._validate_int), '%P')).grid(row=0, column=1, padx=65, sticky=tk.W)
+        tb.Label(self.stitching_frame, text="Stitching Backend").grid(row=1, column=0, pady=5, sticky=tk.W)
+        self.stitch_backend_combo = tb.Combobox(self.stitching_frame, textvariable=self.stitch_backend_text, width=8,
+                                                state='readonly', values=["Fiji", "Python"])
+        self.stitch_backend_combo.grid(row=1, column=1, padx=65, sticky=tk.W)
+        self.stitch_backend_combo.bind("<<ComboboxSelected>>", self._show_hidden_frame_bind)
+        tb.Label(self.stitching_frame, text="Stitched Output").grid(row=2, column=0, pady=5, sticky=tk.W)
+        self.stitch_output_combo = tb.Combobox(self.stitching_frame, textvariable=self.stitch_output_text, width=18,
+                                               state='readonly', values=["ImageJ TIFF", "Pyramidal OME-TIFF"])
+        self.stitch_output_combo.grid(row=2, column=1, padx=65, sticky=tk.W)
+        tb.Label(self.stitching_frame, text="Register").grid(row=3, column=0, pady=5, sticky=tk.W)
+        self.stitch_registration_combo = tb.Combobox(self.stitching_frame, textvariable=self.stitch_registration_text, width=18,
+                                                     state='readonly', values=["every well", "sample wells"])
+        self.stitch_registration_combo.grid(row=3, column=1, padx=65, sticky=tk.W)
 
         self.imagej_frame = tb.Frame(processing_frame)
         tb.Label(self.imagej_frame, text="ImageJ.app Location").grid(row=0, column=0, pady=5, sticky=tk.W)
@@ -198,6 +234,18 @@ class HiConAGUI:
         self.cellpose_niter_int.set(self._set_variable("niter"))
         self.cellpose_batchsize_int = tk.IntVar()
         self.cellpose_batchsize_int.set(self._set_variable("batch_size"))
+        self.cellpose_fov_batch_int = tk.IntVar()
+        self.cellpose_fov_batch_int.set(self._set_variable("fov_batch") if "fov_batch" in self.saved_cellpose_var else 1)
+        self.cellpose_tile_size_int = tk.IntVar()
+        self.cellpose_tile_size_int.set(self._set_variable("tile_size") if "tile_size" in self.saved_cellpose_var else 0)
+        self.cellpose_save_overlay_state = tk.IntVar()
+        self.cellpose_save_overlay_state.set(self._set_variable("save_overlay") if "save_overlay" in self.saved_cellpose_var else 1)
+        self.cellpose_mask_output_text = tk.StringVar()
+        self.cellpose_mask_output_text.set(self._set_variable("mask_output") if "mask_output" in self.saved_cellpose_var else "ROI zip")
+        self.cellpose_measure_state = tk.IntVar()
+        self.cellpose_measure_state.set(self._set_variable("measure") if "measure" in self.saved_cellpose_var else 1)
+        self.cellpose_calibration_int = tk.IntVar()
+        self.cellpose_calibration_int.set(self._set_variable("diameter_calibration") if "diameter_calibration" in self.saved_cellpose_var else 0)
 
         self.advanced_order_text = tk.StringVar()
         self.advanced_order_text.set(self._set_variable("advanced_process_order") if self._set_variable("advanced_process_order") != "0" else "stitched image")
@@ -240,15 +288,17 @@ class HiConAGUI:
             Messagebox.show_info(title="Missing Information", message="Please choose the hs source directory")
         elif self.output_dir == "" or self.src_dir == self.output_dir:
             Messagebox.show_info(title="Missing Information", message="Please choose an output directory that's different from the source directory")
+        elif self.scan_remaining > 0:
+            Messagebox.show_info(message="Please wait for the measurement scan to finish", title="Missing Information")
         elif len(self.measure_var_list) == 0:
             Messagebox.show_info(message="Please click on Update to see available measurements", title="Missing Information")
         elif all(x.get() == 0 for x in self.measure_var_list):
             Messagebox.show_info(message="Please select a measurement to analyse", title="Missing Information")
-        elif self.proj_text.get() == "ImageJ EDF" and self.EDFchannel == 0:
+        elif self.proj_text.get() in ("ImageJ EDF", "Native EDF") and self.EDFchannel == 0:
             Messagebox.show_info(message="Please select a channel for the EDF process", title="Missing Information")
         elif self.stitching_state.get() == 1 and self.stitch_ref_ch == 0:
             Messagebox.show_info(message="Please select a reference channel for the stitching process", title="Missing Information")
-        elif (self.proj_text.get() == "ImageJ EDF" or self.stitching_state.get() == 1) and self.imagej_entry_text.get() == "":
+        elif (self.proj_text.get() == "ImageJ EDF" or (self.stitching_state.get() == 1 and self.stitch_backend_text.get() == "Fiji")) and self.imagej_entry_text.get() == "":
             Messagebox.show_info(message="Please select the location to ImageJ", title="Missing Information")
         #elif (self.imagej_state.get() == 1 and self.cellpose_state.get() == 1):
         #    Messagebox.show_info(message="Please only select one of ImageJ or Cellpose for analysis.", title="Invalid selection")
@@ -343,68 +393,112 @@ class HiConAGUI:
         if self.src_dir == "" or not self.src_dir.endswith("hs"):
             Messagebox.show_info(title="Missing Information", message="Please choose the hs source directory")
         else:
-
-            self.measurement_dict, self.files, self.xml_readers = self._get_measurement_from_src()
-
             # Clear existing widgets
             for widget in self.int_measurement_frame.winfo_children():
                 widget.destroy()
+            self.measure_var_list = []
+            self.measurement_dict = {}
+            self.measurement_paths = {}
+            self.measurement_frames = {}
 
-            for index, measurement in enumerate(self.measurement_dict.keys()):
-                self.measure_var_list.append(tk.IntVar(value=0))
-
-                cb_frame = tb.Frame(self.int_measurement_frame)
-                cb_frame.pack(fill='x', pady=2)
-
-                cb = tb.Checkbutton(cb_frame, variable=self.measure_var_list[index])
-                cb.pack(side='left', padx=(0,5))
-
-                label = tb.Label(cb_frame, text=measurement, wraplength=400, justify='left', anchor='w')
-                label.pack(side='left', fill='x', expand=True)
-
-                # Make label clickable to toggle checkbutton
-                label.bind("<Button-1>", lambda e, var=self.measure_var_list[index]: var.set(1 - var.get()))
+            self._get_measurement_from_src()
 
     def _get_measurement_from_src(self):
-        measurement_dict = {}
-        xml_readers = {}
-        files = {}
-        for measurement in [f for f in os.listdir(self.src_dir) if (os.path.isdir(os.path.join(self.src_dir, f)) and f != "_configdata")]:
-            measurement_path = os.path.join(self.src_dir, measurement)
+        """Scans the measurements on a thread pool, results are added to the list as they arrive."""
+        self.scan_id += 1
+        self.scan_queue = queue.Queue()
+        self.scan_cache = MeasurementCache(self.src_dir)
+
+        with os.scandir(self.src_dir) as it:
+            measurement_paths = [entry.path for entry in it if entry.is_dir() and entry.name != "_configdata"]
+        self.scan_remaining = len(measurement_paths)
+
+        executor = ThreadPoolExecutor(max_workers=self._set_variable("scan_workers") or 8)
+        for measurement_path in measurement_paths:
+            # Only parses the kw.txt and XML when the measurement is new or has changed
+            future = executor.submit(self.scan_cache.get_or_build, measurement_path)
+            future.add_done_callback(lambda f, path=measurement_path, scan_id=self.scan_id: self.scan_queue.put((scan_id, path, f)))
+        executor.shutdown(wait=False)
+
+        self.update_button.config(text="Scanning...")
+        self.master.after(50, self._poll_measurement_scan, self.scan_id)
+
+    def _poll_measurement_scan(self, scan_id):
+        if scan_id != self.scan_id:
+            return  # A newer scan has been started
+
+        while not self.scan_queue.empty():
+            result_id, measurement_path, future = self.scan_queue.get()
+            if result_id != scan_id:
+                continue
+            self.scan_remaining -= 1
+            try:
+                record = future.result()
+            except Exception as e:
+                print(f"Skipping dataset {measurement_path}: {e}")
+                continue
+            if record is not None:
+                self._add_measurement(record, measurement_path)
+
+        if self.scan_remaining > 0:
+            self.master.after(50, self._poll_measurement_scan, scan_id)
+            return
 
-            cur_files = FilePathHandler(measurement_path)
+        # Scan finished, show the measurements sorted by name
+        for name in sorted(self.measurement_frames):
+            self.measurement_frames[name].pack_forget()
+            self.measurement_frames[name].pack(fill='x', pady=2)
+        self.update_button.config(text="Update")
+        self.scan_cache.save()
 
-            if not cur_files.is_valid():
-                continue
+    def _add_measurement(self, record, measurement_path):
+        name = record["plate_name"] + " - " + record["measurement_number"]
+        if name in self.measurement_dict:
+            return
+        self.measurement_dict[name] = record["guid"]
+        self.measurement_paths[record["guid"]] = measurement_path
 
-            opera_config_file = ConfigReader(cur_files.archived_data_config).load()
-            cur_XMLReader = XMLConfigReader(cur_files.archived_data_config_xml)
+        var = tk.IntVar(value=0)
+        self.measure_var_list.append(var)
 
-            plate_name = opera_config_file["PLATENAME"]
-            measure_num = opera_config_file["MEASUREMENT"].split(" ")
-            guid = opera_config_file["GUID"]
+        cb_frame = tb.Frame(self.int_measurement_frame)
+        cb_frame.pack(fill='x', pady=2)
+        self.measurement_frames[name] = cb_frame
 
-            name = plate_name + " - " + measure_num[-1]
-            measurement_dict[name] = guid
+        cb = tb.Checkbutton(cb_frame, variable=var)
+        cb.pack(side='left', padx=(0,5))
 
-            files[guid] = cur_files
-            xml_readers[guid] = cur_XMLReader
+        label = tb.Label(cb_frame, text=name, wraplength=400, justify='left', anchor='w')
+        label.pack(side='left', fill='x', expand=True)
 
-        return dict(sorted(measurement_dict.items())), files, xml_readers
+        # Make label clickable to toggle checkbutton
+        label.bind("<Button-1>", lambda e, var=var: var.set(1 - var.get()))
 
     def _get_measurement_to_process(self):
         measurement_to_process = [self.measurement_dict[list(self.measurement_dict.keys())[i]] for i in range(len(self.measurement_dict)) if self.measure_var_list[i].get() == 1]
+        files = {}
+        xml_readers = {}
+        # Only the selected measurements are fully opened
+        for guid in measurement_to_process:
+            files[guid] = FilePathHandler(self.measurement_paths[guid])
+            xml_readers[guid] = XMLConfigReader(files[guid].archived_data_config_xml)
         # returns key: guid, value: files
-        return  dict(zip(measurement_to_process, [self.files[j] for j in measurement_to_process])), dict(zip(measurement_to_process, [self.xml_readers[j] for j in measurement_to_process]))
+        return files, xml_readers
 
     def _define_processing(self):
-        processing_selection = {'hyperstack': self.hyperstack_state.get(),
+        # Keep options that are only set in processing_variables.json, e.g. io_workers
+        processing_selection = self.saved_process_var | {'hyperstack': self.hyperstack_state.get(),
+                                'plate_overview': self.overview_state.get(),
                                 '8bit': self.bit8_state.get(),
+                                '8bit_mode': self.bit8_mode_text.get(),
                                 'sep_ch': self.sep_ch_state.get(),
                                 'proj': self.proj_text.get(),
                                 'EDF_channel': self.edf_ch_int.get(),
                                 'stitching': self.stitching_state.get(),
                                 'stitch_ref_ch': self.stitching_ch_int.get(),
+                                'stitch_backend': self.stitch_backend_text.get(),
+                                'stitch_output': self.stitch_output_text.get(),
+                                'stitch_registration': self.stitch_registration_text.get(),
                                 'imagej_loc': self.imagej_entry_text.get(),
                                 'cellpose': self.cellpose_state.get(),
                                 'imagej': self.imagej_state.get(),
@@ -442,16 +536,16 @@ class HiConAGUI:
 
     def _show_hidden_frame_bind(self, e):
             showimageJ = [0,0]
-            if self.proj_text.get() == "ImageJ EDF":
+            if self.proj_text.get() in ("ImageJ EDF", "Native EDF"):
                 self.edf_frame.grid(row=4, columnspan=4, pady=10, sticky=tk.W)
-                showimageJ[0] = 1
+                showimageJ[0] = 1 if self.proj_text.get() == "ImageJ EDF" else 0
             else:
                 self.edf_frame.grid_forget()
                 showimageJ[0] = 0
 
             if self.stitching_state.get() == 1:
                 self.stitching_frame.grid(row=6, columnspan=4, pady=10, sticky=tk.W)
-                showimageJ[1] = 1
+                showimageJ[1] = 1 if self.stitch_backend_text.get() == "Fiji" else 0
             else:
                 self.stitching_frame.grid_forget()
                 showimageJ[1] = 0
@@ -527,13 +621,19 @@ class HiConAGUI:
         self.cellpose_cellprob_threshold_double.set(0.0)
         self.cellpose_niter_int.set(0)
         self.cellpose_batchsize_int.set(64)
+        self.cellpose_fov_batch_int.set(1)
+        self.cellpose_tile_size_int.set(0)
+        self.cellpose_save_overlay_state.set(1)
+        self.cellpose_mask_output_text.set("ROI zip")
+        self.cellpose_measure_state.set(1)
+        self.cellpose_calibration_int.set(0)
 
     def _show_cellpose_settings(self, e):
         if self.cellpose_state.get() == 0:
             return
         cellpose_window = tb.Toplevel(self.master)
         cellpose_window.title("Settings for Cellpose segmentation")
-        cellpose_window.geometry("560x740")
+        cellpose_window.geometry("560x1050")
 
         cellpose_window.transient(self.master)
 
@@ -590,19 +690,55 @@ class HiConAGUI:
                                             validatecommand=(self.master.register(self._validate_int), '%P'))
         batchsize_entry.grid(row=9, column=1, padx=10, pady=10, sticky=tk.W)
 
+        fov_batch_label = tb.Label(cellpose_window, text="Images per eval (0 = well)", font=("Segoe UI", 10))
+        fov_batch_label.grid(row=10, column=0, pady=10, sticky=tk.E)
+        fov_batch_entry = tb.Entry(cellpose_window, textvariable=self.cellpose_fov_batch_int, width=4, background="White", validate='key',
+                                            validatecommand=(self.master.register(self._validate_int), '%P'))
+        fov_batch_entry.grid(row=10, column=1, padx=10, pady=10, sticky=tk.W)
+
+        tile_size_label = tb.Label(cellpose_window, text="Tile size (0 = whole image)", font=("Segoe UI", 10))
+        tile_size_label.grid(row=11, column=0, pady=10, sticky=tk.E)
+        tile_size_entry = tb.Entry(cellpose_window, textvariable=self.cellpose_tile_size_int, width=6, background="White", validate='key',
+                                            validatecommand=(self.master.register(self._validate_int), '%P'))
+        tile_size_entry.grid(row=11, column=1, padx=10, pady=10, sticky=tk.W)
+
+        save_overlay_check = tb.Checkbutton(cellpose_window, text="Save mask overlay", variable=self.cellpose_save_overlay_state)
+        save_overlay_check.grid(row=12, column=1, padx=10, pady=10, sticky=tk.W)
+
+        mask_output_label = tb.Label(cellpose_window, text="Mask output", font=("Segoe UI", 10))
+        mask_output_label.grid(row=13, column=0, pady=10, sticky=tk.E)
+        mask_output_combobox = tb.Combobox(cellpose_window, textvariable=self.cellpose_mask_output_text, width=15,
+                                           state='readonly', values=["ROI zip", "label image", "both"])
+        mask_output_combobox.grid(row=13, column=1, padx=10, pady=10, sticky=tk.W)
+
+        measure_check = tb.Checkbutton(cellpose_window, text="Measure cells", variable=self.cellpose_measure_state)
+        measure_check.grid(row=14, column=1, padx=10, pady=10, sticky=tk.W)
+
+        calibration_label = tb.Label(cellpose_window, text="Diameter sample FOVs (0 = off)", font=("Segoe UI", 10))
+        calibration_label.grid(row=15, column=0, pady=10, sticky=tk.E)
+        calibration_entry = tb.Entry(cellpose_window, textvariable=self.cellpose_calibration_int, width=4, background="White", validate='key',
+                                            validatecommand=(self.master.register(self._validate_int), '%P'))
+        calibration_entry.grid(row=15, column=1, padx=10, pady=10, sticky=tk.W)
 
         confirm_button = tb.Button(cellpose_window, text="Confirm", command=lambda: self._cellpose_confirm(cellpose_window), bootstyle="info")
-        confirm_button.grid(row=10, column=2, pady=10, sticky=tk.E)
+        confirm_button.grid(row=16, column=2, pady=10, sticky=tk.E)
 
     def _cellpose_confirm(self, window):
-        cellpose_config_dict = {'model': self.cellpose_model_text.get(),
+        # Keep options that are only set in cellpose_config.json
+        cellpose_config_dict = self.saved_cellpose_var | {'model': self.cellpose_model_text.get(),
                                 'diameter': self.cellpose_diameter_double.get(),
                                 'channel1': self.cellpose_channel_1_int.get(),
                                 'channel2': self.cellpose_channel_2_int.get(),
                                 'flow_threshold': self.cellpose_flow_threshold_double.get(),
                                 'cellprob_threshold': self.cellpose_cellprob_threshold_double.get(),
                                 'niter': self.cellpose_niter_int.get(),
-                                'batch_size': self.cellpose_batchsize_int.get()}
+                                'batch_size': self.cellpose_batchsize_int.get(),
+                                'fov_batch': self.cellpose_fov_batch_int.get(),
+                                'tile_size': self.cellpose_tile_size_int.get(),
+                                'save_overlay': self.cellpose_save_overlay_state.get(),
+                                'mask_output': self.cellpose_mask_output_text.get(),
+                                'measure': self.cellpose_measure_state.get(),
+                                'diameter_calibration': self.cellpose_calibration_int.get()}
 
         with open(self.saved_cellpose_variables_f, "w+") as f:
             json.dump(cellpose_config_dict, f)
@@ -611,7 +747,7 @@ class HiConAGUI:
         window.destroy()
 
     def _check_options_selected(self):
-        options = [self.hyperstack_state.get(), self.bit8_state.get(), self.sep_ch_state.get(), self.stitching_state.get(), self.imagej_state.get(), self.cellpose_state.get()]
+        options = [self.hyperstack_state.get(), self.overview_state.get(), self.bit8_state.get(), self.sep_ch_state.get(), self.stitching_state.get(), self.imagej_state.get(), self.cellpose_state.get()]
         if all(v == 0 for v in options) and self.proj_text.get() == "None":
             return 0
         else:
@@ -3,6 +3,7 @@ import os
 
 class XMLConfigReader:
     def __init__(self, file_path):
+        self.file_path = file_path
         self.tree = ET.parse(file_path)
         self.ns = self._get_namespace()
         self.pixel_size = self._get_pixel_size()
@@ -56,6 +57,18 @@ class XMLConfigReader:
             well_layout[well_name] = field_layout
 
         return well_layout
+
+    def get_well_sublayouts(self):
+        """SublayoutID of every well, wells sharing one have the same field layout."""
+        wells = self.tree.findall('.//ns:Experiment/ns:MeasurementLayout/ns:Wells/ns:Well', self.ns)
+
+        well_sublayouts = {}
+        for well in wells:
+            col = well.find('ns:Col', self.ns).text
+            row = well.find('ns:Row', self.ns).text
+            well_sublayouts["r"+row.zfill(2)+"c"+col.zfill(2)] = int(well.find('ns:SublayoutID', self.ns).text)
+
+        return well_sublayouts
     
     def generate_TileConfiguration(self, well_layout, well_name, output_dir):
         top_text = ['# Define the number of dimensions we are working on', 'dim = 2', '# Define the image coordinates (in pixels)']
@@ -2,6 +2,49 @@ import os
 import re
 
 
+class WellImageIndex:
+    """Index of every Opera image in a well, built from a single directory scan."""
+    # e.g. r02c03f01p04-ch2t01.tiff, timepoint defaults to 1 if the name has none
+    OPERA_IMAGE_PATTERN = re.compile(r'^r(\d+)c(\d+)f(\d+)p(\d+)-ch(\d+)(?:t|sk)?(\d+)?.*\.tiff?$', re.IGNORECASE)
+
+    def __init__(self, well_path: str):
+        self.well_path = well_path
+        self.images = {}  # (field, timepoint) -> paths sorted by plane then channel
+
+        entries = []
+        with os.scandir(well_path) as it:
+            for entry in it:
+                if entry.name.startswith("._") or not entry.is_file():
+                    continue
+                parsed = self.parse_image_name(entry.name)
+                if parsed is None:
+                    continue
+                entries.append((parsed, entry.path))
+
+        entries.sort(key=lambda e: (e[0]["field"], e[0]["timepoint"], e[0]["plane"], e[0]["channel"]))
+        for parsed, path in entries:
+            self.images.setdefault((parsed["field"], parsed["timepoint"]), []).append(path)
+
+        self.fields = sorted({field for field, _ in self.images})
+        self.timepoints = sorted({t for _, t in self.images})
+
+    @classmethod
+    def parse_image_name(cls, file_name: str):
+        match = cls.OPERA_IMAGE_PATTERN.match(file_name)
+        if not match:
+            return None
+        row, col, field, plane, channel, timepoint = match.groups()
+        return {"row": int(row),
+                "col": int(col),
+                "field": int(field),
+                "plane": int(plane),
+                "channel": int(channel),
+                "timepoint": int(timepoint) if timepoint is not None else 1}
+
+    def get_images(self, field: int, timepoint=None):
+        return self.images.get((field, timepoint if timepoint is not None else 1), [])
+
+
 class FilePathHandler:
     def __init__(self, archived_data_path: str):
         self.archived_data_path = archived_data_path + "\\"
@@ -9,19 +52,22 @@ class FilePathHandler:
         self.archived_data_config_xml = None
         self.archived_data_config = None
         self.well_names = []
+        self._well_indexes = {}
 
         if not os.path.exists(self.archived_data_path):
             return
 
-        self.xml_file_match = self._get_name_from_regexstring(archived_data_path, r".*\.xml")
+        data_files = self._list_dir(archived_data_path)
+        self.xml_file_match = [file_name for file_name in data_files if file_name.lower().endswith(".xml")]
         if self.xml_file_match:
             self.archived_data_config_xml = os.path.join(self.archived_data_path,self.xml_file_match[0])
 
-        self.kw_file_match = self._get_name_from_regexstring(archived_data_path,r".*\.kw\.txt")
+        self.kw_file_match = [file_name for file_name in data_files if file_name.lower().endswith(".kw.txt")]
         if self.kw_file_match:
             self.archived_data_config = os.path.join(archived_data_path, self.kw_file_match[0])
 
-        self.well_names = self._get_name_from_regexstring(self.archived_image_path, r'r(\d+)c(\d+)')
+        if os.path.isdir(self.archived_image_path):
+            self.well_names = [name for name in self._list_dir(self.archived_image_path) if re.fullmatch(r'r\d+c\d+', name)]
 
     def is_valid(self):
         # If the config file is missing, we can't interpret the images
@@ -34,33 +80,19 @@ class FilePathHandler:
             return False
         return True
 
-    def _get_name_from_regexstring(self, dir_path: str, str_pattern: str):
-        matched_strings = []
-        macos_metadata_files = "._"
-
-        for file_name in sorted(os.listdir(dir_path)):
-            if file_name.startswith(macos_metadata_files):
-                continue
-            match = re.search(str_pattern, file_name)
-            if match:
-                matched_strings.append(match.group())
-
-        return matched_strings
-
-    # DO we need the below function in class or should we grab the images to process when needed
-    def get_opera_phenix_images_from_FOV(self, well_name: str, pattern):
-        well_path = os.path.join(self.archived_image_path, well_name)
-        image_files = self._get_name_from_regexstring(well_path, pattern)
-        return [os.path.join(well_path, file) for file in image_files]
-
-    def build_imagename_pattern(self, FOV, timepoint=None):
-        pattern = "r(\\d+)c(\\d+)f(0?)" + str(FOV) + "p(\\d+)-(ch(\\d+))"
-        if timepoint is not None:
-            pattern += f"t0?{timepoint}"
-        else:
-            pattern += "t0?1"
-        pattern += ".tiff"
-        return pattern
+    def _list_dir(self, dir_path: str):
+        # Skips the ._ metadata files macOS leaves on network shares
+        return sorted(file_name for file_name in os.listdir(dir_path) if not file_name.startswith("._"))
+
+    def get_well_index(self, well_name):
+        """Scans the well directory once and reuses the index for every later lookup."""
+        if well_name not in self._well_indexes:
+            self._well_indexes[well_name] = WellImageIndex(self.get_file_path(well_name))
+        return self._well_indexes[well_name]
+
+    def get_fov_images(self, well_name, FOV, timepoint=None):
+        """Image paths for one FOV and timepoint, sorted by plane then channel."""
+        return self.get_well_index(well_name).get_images(FOV, timepoint)
 
     def create_dir(self, save_path):
         return os.makedirs(save_path, exist_ok=True)
@@ -69,20 +101,7 @@ class FilePathHandler:
         return os.path.join(self.archived_image_path, well_name)
 
     def get_well_fov_list(self, well_name):
-        well_path = self.get_file_path(well_name)
-        image_names = os.listdir(well_path)
-        fovs = set()
-        # This pattern says: "Find 'f', then capture all digits that follow it"
-        # It stops as soon as it hits a non-digit (like 'p', 'c', or '_')
-        fov_pattern = re.compile(r'f(\d+)')
-        for f in image_names:
-            if f.endswith(".db"):
-                continue
-            match = fov_pattern.search(f)
-            if match:
-                # .group(1) is JUST the numbers (e.g., '01')
-                fovs.add(int(match.group(1)))
-        return sorted(list(fovs))
+        return self.get_well_index(well_name).fields
 
 if __name__ == "__main__":
     archived_data_path = r"Y:\Emma\Opera Phenix Test Data\hs\4e88424a-8346-4ec4-8142-cecbf124b857"
@@ -1,11 +1,59 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import tifffile
 import numpy as np
 
-def load_images(filepaths):
-    im_arr = np.array([tifffile.imread(fp) for fp in filepaths])
+from HiConA.Utilities.Image_Utils import downsample_mean, encode_label_rle, decode_label_rle
+
+DEFAULT_IO_WORKERS = min(8, os.cpu_count() or 1)
+
+def load_images(filepaths, max_workers=None):
+    """Decodes the images in parallel into a single preallocated (N, Y, X) array."""
+    if len(filepaths) == 0:
+        return np.array([])
+
+    start_time = time.perf_counter()
+
+    # All planes of an Opera FOV share one shape and dtype, so the first header is enough
+    with tifffile.TiffFile(filepaths[0]) as tif:
+        shape = tif.series[0].shape
+        dtype = tif.series[0].dtype
+    im_arr = np.empty((len(filepaths), *shape), dtype=dtype)
+
+    def _read_image(index):
+        tifffile.imread(filepaths[index], out=im_arr[index])
+
+    # tifffile/imagecodecs release the GIL while decoding
+    with ThreadPoolExecutor(max_workers=max_workers or DEFAULT_IO_WORKERS) as executor:
+        list(executor.map(_read_image, range(len(filepaths))))
+
+    elapsed = time.perf_counter() - start_time
+    size_mb = im_arr.nbytes / 1e6
+    print(f"Loaded {len(filepaths)} images ({size_mb:.1f} MB) in {elapsed:.2f} s, {size_mb / max(elapsed, 1e-9):.1f} MB/s")
     return im_arr
 
+def read_image(filepath, mmap=True):
+    """Returns a read-only np.memmap of the image when it is stored contiguously and uncompressed, otherwise decodes it."""
+    with tifffile.TiffFile(filepath) as tif:
+        series = tif.series[0]
+        # dataoffset is only set when the image data are contiguous and uncompressed
+        if mmap and series.dataoffset is not None:
+            dtype = np.dtype(series.dtype).newbyteorder(tif.byteorder)
+            return np.memmap(filepath, dtype=dtype, mode='r', offset=series.dataoffset, shape=series.shape)
+        return series.asarray()
+
+def read_pixel_size(filepath, default=1.0):
+    """Pixel size in um from the XResolution tag written by save_images, default when the file has none."""
+    if not os.path.isfile(filepath):
+        return default
+    with tifffile.TiffFile(filepath) as tif:
+        resolution = tif.pages[0].tags.get('XResolution')
+    if resolution is None or not resolution.value[0]:
+        return default
+    numerator, denominator = resolution.value
+    return denominator / numerator
+
 def save_images(full_file_path, images, pixel_size_um, axes_order, channels):    
     tifffile.imwrite(full_file_path,
                      images,
@@ -20,7 +68,116 @@ def save_images(full_file_path, images, pixel_size_um, axes_order, channels):
                             'PhysicalSizeYUnit': 'um',
                             'Labels': channels}
                     )
+
+def create_image_memmap(full_file_path, shape, dtype, pixel_size_um, axes_order, channels):
+    """Creates an empty TIFF on disk and returns it as a writable np.memmap, same metadata as save_images.
+    Files that do not fit a classic TIFF are written as BigTIFF, which ImageJ hyperstacks do not support."""
+    bigtiff = int(np.prod(shape)) * np.dtype(dtype).itemsize > 2**32 - 2**25
+    kwargs = {'bigtiff': True} if bigtiff else {'imagej': True}
+    return tifffile.memmap(full_file_path,
+                           shape=shape,
+                           dtype=dtype,
+                           photometric='minisblack',
+                           resolution=(1.0/pixel_size_um, 1.0/pixel_size_um),
+                           metadata={'axes': axes_order,
+                                  'unit': 'um',
+                                  'PhysicalSizeX': pixel_size_um,
+                                  'PhysicalSizeY': pixel_size_um,
+                                  'PhysicalSizeXUnit': 'um',
+                                  'PhysicalSizeYUnit': 'um',
+                                  'Labels': channels},
+                           **kwargs)
     
+def save_pyramidal_ome(full_file_path, image, pixel_size_um, channels, axes="CYX", tile_size=512):
+    """Writes an image ending in YX (e.g. CYX, TCYX) as tiled OME-TIFF with 2x, 4x, 8x... block-mean levels in sub-IFDs.
+
+    Full resolution tiles are streamed from the image one row of tiles at a time, e.g. from a memmap,
+    and every level is reduced from that band as it passes, so only the smaller levels are held in memory.
+    """
+    start_time = time.perf_counter()
+    height, width = image.shape[-2:]
+    planes = image.reshape(-1, height, width)
+    integer_output = np.issubdtype(image.dtype, np.integer)
+
+    # Halve until the overview fits in a single tile
+    levels = []
+    while min(height, width) >> len(levels) > tile_size:
+        factor = 2 ** (len(levels) + 1)
+        levels.append(np.empty((len(planes), height // factor, width // factor), dtype=image.dtype))
+
+    def _full_resolution_tiles():
+        for p, plane in enumerate(planes):
+            for y0 in range(0, height, tile_size):
+                band = np.asarray(plane[y0:y0 + tile_size])
+                reduced = band
+                for k, level in enumerate(levels, start=1):
+                    reduced = downsample_mean(reduced, 2)
+                    level_band = np.rint(reduced) if integer_output else reduced
+                    level[p, (y0 >> k):(y0 >> k) + level_band.shape[0]] = level_band
+                for x0 in range(0, width, tile_size):
+                    yield band[:, x0:x0 + tile_size]
+
+    with tifffile.TiffWriter(full_file_path, bigtiff=True) as tif:
+        tif.write(_full_resolution_tiles(),
+                  shape=image.shape,
+                  dtype=image.dtype,
+                  tile=(tile_size, tile_size),
+                  subifds=len(levels),
+                  photometric='minisblack',
+                  resolution=(1.0/pixel_size_um, 1.0/pixel_size_um),
+                  metadata={'axes': axes,
+                            'PhysicalSizeX': pixel_size_um,
+                            'PhysicalSizeY': pixel_size_um,
+                            'Channel': {'Name': list(channels)}})
+        for k, level in enumerate(levels, start=1):
+            level_pixel_size = pixel_size_um * 2 ** k
+            tif.write(level.reshape(*image.shape[:-2], *level.shape[-2:]),
+                      subfiletype=1,
+                      tile=(tile_size, tile_size),
+                      photometric='minisblack',
+                      resolution=(1.0/level_pixel_size, 1.0/level_pixel_size))
+
+    print(f"Saved pyramidal OME-TIFF with {len(levels) + 1} levels in {time.perf_counter() - start_time:.2f} s")
+    return full_file_path
+
+
+def save_label_image(full_file_path, labels, compression='zlib', tile_size=512):
+    """Writes a YX label image as a compressed, tiled uint16 TIFF, or uint32 above 65535 labels.
+
+    The tiles are streamed from the labels, e.g. a memmap, so the label image is never copied as a whole.
+    """
+    dtype = np.uint16 if int(np.max(labels)) <= np.iinfo(np.uint16).max else np.uint32
+    height, width = labels.shape
+
+    def _tiles():
+        for y0 in range(0, height, tile_size):
+            band = np.asarray(labels[y0:y0 + tile_size])
+            for x0 in range(0, width, tile_size):
+                yield band[:, x0:x0 + tile_size].astype(dtype)
+
+    tifffile.imwrite(full_file_path,
+                     _tiles(),
+                     shape=labels.shape,
+                     dtype=dtype,
+                     tile=(tile_size, tile_size),
+                     compression=compression,
+                     photometric='minisblack',
+                     bigtiff=labels.size * np.dtype(dtype).itemsize > 2**32 - 2**25)
+    return full_file_path
+
+def save_label_rle(full_file_path, labels):
+    """Writes a YX label image as run-length encoded (starts, lengths, values) to a compressed .npz."""
+    starts, lengths, values = encode_label_rle(labels)
+    np.savez_compressed(full_file_path, shape=labels.shape, starts=starts, lengths=lengths, values=values)
+    return full_file_path
+
+def load_label_image(full_file_path):
+    """Reads a label image written by save_label_image or save_label_rle."""
+    if full_file_path.endswith('.npz'):
+        with np.load(full_file_path) as rle:
+            return decode_label_rle(tuple(rle['shape']), rle['starts'], rle['lengths'], rle['values'])
+    return tifffile.imread(full_file_path)
+
 
 def create_directory(output_path: str) -> str:
     os.makedirs(output_path, exist_ok=True)
@@ -16,4 +16,186 @@ def get_xy_axis_from_image(image: np.array) -> tuple[Any, Any]:
     x_axis = image.shape[-1]
     y_axis = image.shape[-2]
 
-    return y_axis, x_axis
\ No newline at end of file
+    return y_axis, x_axis
+
+def build_8bit_lut(min_value=0, max_value=np.iinfo(np.uint16).max):
+    """
+    Builds a 65536-entry uint16 -> uint8 lookup table.
+
+    Parameters:
+    min_value (int): Intensity mapped to 0.
+    max_value (int): Intensity mapped to 255.
+
+    Returns:
+    np.array: uint8 lookup table, values outside the window are clipped.
+    """
+    values = np.arange(np.iinfo(np.uint16).max + 1, dtype=np.float64)
+    # Multiplied before dividing, so max_value maps to exactly 255 rather than 254.99...
+    scaled = (values - min_value) * 255 / max(max_value - min_value, 1)
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def convert_to_8bit(image: np.array, mode="full range", min_value=None, max_value=None, channel_axis=-3, chunk_rows=512) -> np.array:
+    """
+    Converts an image of any axis order to uint8 in one pass, without float64 temporaries.
+
+    Parameters:
+    image (np.array): Image to convert, e.g. TZCYX or CYX.
+    mode (str): 'full range' maps 0-65535, 'fixed' maps min_value-max_value, 'per channel' maps each channel's own min-max.
+    min_value, max_value (int or list): Window for 'fixed', a list gives one window per channel.
+    channel_axis (int): Axis holding the channels, None if the image has no channel axis.
+    chunk_rows (int): Rows converted at a time, bounds the size of the index temporaries.
+
+    Returns:
+    np.array: uint8 image with the same shape as the input.
+    """
+    image = np.asarray(image)
+    output = np.empty(image.shape, dtype=np.uint8)
+
+    if channel_axis is None or image.ndim < 3:
+        src_channels, dst_channels = image[np.newaxis], output[np.newaxis]
+    else:
+        src_channels, dst_channels = np.moveaxis(image, channel_axis, 0), np.moveaxis(output, channel_axis, 0)
+    num_channels = src_channels.shape[0]
+
+    if mode == "per channel":
+        windows = [(float(np.min(ch)), float(np.max(ch))) for ch in src_channels]
+    elif mode == "fixed":
+        min_value = 0 if min_value is None else min_value
+        max_value = np.iinfo(np.uint16).max if max_value is None else max_value
+        mins = min_value if isinstance(min_value, (list, tuple)) else [min_value] * num_channels
+        maxs = max_value if isinstance(max_value, (list, tuple)) else [max_value] * num_channels
+        windows = list(zip(mins, maxs))
+    else:
+        windows = [(0, np.iinfo(np.uint16).max)] * num_channels
+
+    for ch in range(num_channels):
+        min_ch, max_ch = windows[ch]
+        value_range = max(max_ch - min_ch, 1)
+        lut = build_8bit_lut(min_ch, max_ch) if image.dtype == np.uint16 else None
+        src, dst = src_channels[ch], dst_channels[ch]
+        for index in np.ndindex(src.shape[:-2]):
+            plane_in, plane_out = src[index], dst[index]
+            for y in range(0, plane_in.shape[0], chunk_rows):
+                rows = slice(y, y + chunk_rows)
+                if lut is not None:
+                    np.take(lut, plane_in[rows], out=plane_out[rows])
+                else:
+                    # Float projections (Sum, Mean, StdDev) are scaled in float32 chunks
+                    scaled = (plane_in[rows].astype(np.float32) - min_ch) * (255.0 / value_range)
+                    np.floor(scaled, out=scaled)
+                    np.clip(scaled, 0, 255, out=scaled)
+                    # float32 rounding can leave the window maximum just below 255
+                    if max_ch > min_ch:
+                        scaled[plane_in[rows] >= max_ch] = 255
+                    plane_out[rows] = scaled
+    return output
+
+
+def downsample_mean(image: np.array, factor=2) -> np.array:
+    """
+    Block-mean downsampling of the last two axes.
+
+    Parameters:
+    image (np.array): Image of any axis order ending in YX.
+    factor (int): Size of the square blocks that are averaged.
+
+    Returns:
+    np.array: float32 image, rows and columns that do not fill a whole block are dropped.
+    """
+    h, w = image.shape[-2] // factor, image.shape[-1] // factor
+    blocks = np.asarray(image[..., :h * factor, :w * factor], dtype=np.float32)
+    return blocks.reshape(*image.shape[:-2], h, factor, w, factor).mean(axis=(-3, -1))
+
+
+def build_label_lut(num_colours=256, seed=0) -> np.array:
+    """
+    Builds a random colour lookup table for label images.
+
+    Parameters:
+    num_colours (int): Number of colours, labels wrap around the table.
+    seed (int): Seed of the colours, fixed so overlays of a plate use the same colours.
+
+    Returns:
+    np.array: (num_colours, 3) uint8 colours, bright enough to stand out on a grey image.
+    """
+    rng = np.random.default_rng(seed)
+    return rng.integers(64, 256, size=(num_colours, 3), dtype=np.uint8)
+
+
+def render_label_overlay(image: np.array, labels: np.array, alpha=0.5, max_size=2048, percentiles=(1, 99.8)) -> np.array:
+    """
+    Blends coloured labels over a greyscale image.
+
+    Parameters:
+    image (np.array): YX image the labels were segmented from.
+    labels (np.array): YX label image, 0 is background.
+    alpha (float): Opacity of the labels.
+    max_size (int): Longest side of the overlay, larger images are subsampled first. 0 keeps the full size.
+    percentiles (tuple): Intensity percentiles mapped to black and white.
+
+    Returns:
+    np.array: YX3 uint8 RGB overlay.
+    """
+    step = max(1, -(-max(labels.shape) // max_size)) if max_size else 1
+    # Nearest-neighbour subsampling keeps the labels intact and only reads the rows that are shown
+    labels = np.asarray(labels[::step, ::step])
+    grey = np.asarray(image[::step, ::step], dtype=np.float32)
+
+    low, high = np.percentile(grey, percentiles)
+    grey -= low
+    grey *= 255 / max(high - low, 1e-6)
+    np.clip(grey, 0, 255, out=grey)
+
+    lut = build_label_lut()
+    overlay = np.repeat(grey[..., np.newaxis], 3, axis=-1)
+    foreground = labels > 0
+    colours = lut[labels[foreground] % len(lut)]
+    overlay[foreground] = (1 - alpha) * overlay[foreground] + alpha * colours
+    return overlay.astype(np.uint8)
+
+
+def encode_label_rle(labels: np.array, chunk_rows=1024) -> tuple[np.array, np.array, np.array]:
+    """
+    Run-length encodes the foreground of a label image in row-major order.
+
+    Parameters:
+    labels (np.array): YX label image, 0 is background.
+    chunk_rows (int): Rows encoded at a time, runs are split at chunk borders.
+
+    Returns:
+    tuple: int64 flat start indices, int64 run lengths and the label of every run.
+    """
+    width = labels.shape[-1]
+    starts, lengths, values = [], [], []
+    for y in range(0, labels.shape[0], chunk_rows):
+        flat = np.asarray(labels[y:y + chunk_rows]).ravel()
+        # A run starts wherever the label changes, background runs are dropped
+        run_starts = np.concatenate(([0], np.flatnonzero(np.diff(flat)) + 1))
+        run_lengths = np.diff(np.append(run_starts, len(flat)))
+        run_values = flat[run_starts]
+        keep = run_values > 0
+        starts.append(run_starts[keep] + y * width)
+        lengths.append(run_lengths[keep])
+        values.append(run_values[keep])
+    if not starts:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, labels.dtype)
+    return np.concatenate(starts).astype(np.int64), np.concatenate(lengths).astype(np.int64), np.concatenate(values)
+
+
+def decode_label_rle(shape: tuple, starts: np.array, lengths: np.array, values: np.array) -> np.array:
+    """
+    Rebuilds a label image from encode_label_rle.
+
+    Parameters:
+    shape (tuple): YX shape of the label image.
+    starts, lengths, values (np.array): Runs from encode_label_rle.
+
+    Returns:
+    np.array: Label image with the dtype of values.
+    """
+    flat = np.zeros(int(np.prod(shape)), dtype=values.dtype)
+    # Offset of every foreground pixel from the start of its run
+    run_offsets = np.arange(int(np.sum(lengths))) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    flat[np.repeat(starts, lengths) + run_offsets] = np.repeat(values, lengths)
+    return flat.reshape(shape)
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import threading
+
+from platformdirs import user_cache_dir
+
+from HiConA.Utilities.ConfigReader import ConfigReader
+from HiConA.Utilities.FileManagement import FilePathHandler
+
+
+class MeasurementCache:
+    """JSON-lines cache of measurement metadata, so unchanged measurements are never re-parsed.
+
+    Invalid measurements are cached too, as records with valid set to False.
+    """
+    CACHE_FILE_NAME = ".hicona_measurements.jsonl"
+
+    def __init__(self, hs_root):
+        self.hs_root = hs_root
+        self.cache_file = self._get_cache_file(hs_root)
+        self.records = self._load()
+        self._dirty = False
+        self._lock = threading.Lock()  # Measurements are scanned from a thread pool
+
+    def _get_cache_file(self, hs_root):
+        cache_file = os.path.join(hs_root, self.CACHE_FILE_NAME)
+        if os.access(hs_root, os.W_OK):
+            return cache_file
+        # Archives are often read-only shares, fall back to the user cache dir
+        cache_dir = user_cache_dir("HiConA")
+        os.makedirs(cache_dir, exist_ok=True)
+        root_hash = hashlib.sha1(os.path.abspath(hs_root).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir, f"measurements_{root_hash}.jsonl")
+
+    def _load(self):
+        records = {}
+        if not os.path.isfile(self.cache_file):
+            return records
+        with open(self.cache_file, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    records[record["measurement"]] = record
+                except (ValueError, KeyError):
+                    continue  # Skip partially written lines
+        return records
+
+    def _get_signature(self, measurement_path):
+        """mtimes and sizes of everything the metadata is read from."""
+        signature = {"dir_mtime": os.stat(measurement_path).st_mtime_ns}
+        with os.scandir(measurement_path) as it:
+            for entry in it:
+                if entry.name.startswith("._"):
+                    continue
+                if entry.name.endswith(".xml") or entry.name.endswith(".kw.txt") or entry.name == "images":
+                    stat = entry.stat()
+                    signature[entry.name] = [stat.st_mtime_ns, stat.st_size if entry.is_file() else 0]
+        return signature
+
+    def get(self, measurement_path):
+        """Returns the cached record, or None if it is missing or stale."""
+        record = self.records.get(os.path.basename(measurement_path))
+        if record is None:
+            return None
+        if record["signature"] != self._get_signature(measurement_path):
+            return None
+        return record
+
+    def _store(self, record):
+        with self._lock:
+            self.records[record["measurement"]] = record
+            self._dirty = True
+        return record
+
+    def build_record(self, measurement_path):
+        """Parses the measurement and stores the result. Returns None for invalid measurements.
+
+        Only the kw.txt is read, the XML is parsed when a measurement is selected for processing.
+        """
+        signature = self._get_signature(measurement_path)
+        invalid_record = {"measurement": os.path.basename(measurement_path), "signature": signature, "valid": False}
+        files = FilePathHandler(measurement_path)
+        if not files.is_valid():
+            self._store(invalid_record)
+            return None
+
+        opera_config_file = ConfigReader(files.archived_data_config).load()
+        if opera_config_file is None:
+            self._store(invalid_record)
+            return None
+
+        return self._store({"measurement": os.path.basename(measurement_path),
+                            "signature": signature,
+                            "valid": True,
+                            "plate_name": opera_config_file["PLATENAME"],
+                            "guid": opera_config_file["GUID"],
+                            "measurement_number": opera_config_file["MEASUREMENT"].split(" ")[-1],
+                            "wells": files.well_names})
+
+    def get_or_build(self, measurement_path):
+        """Returns the record of a valid measurement, None for invalid ones."""
+        record = self.get(measurement_path)
+        if record is None:
+            record = self.build_record(measurement_path)
+        if record is None or not record.get("valid", True):
+            return None
+        return record
+
+    def save(self):
+        if not self._dirty:
+            return
+        # Drop measurements that have been removed from the hs root
+        with self._lock:
+            records = list(self.records.values())
+        existing = [r for r in records if os.path.isdir(os.path.join(self.hs_root, r["measurement"]))]
+        temp_file = self.cache_file + ".tmp"
+        try:
+            with open(temp_file, "w") as f:
+                for record in existing:
+                    f.write(json.dumps(record) + "\n")
+            os.replace(temp_file, self.cache_file)
+            self._dirty = False
+        except OSError as e:
+            print(f"Could not write measurement cache {self.cache_file}: {e}")
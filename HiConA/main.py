@@ -2,6 +2,7 @@ import ttkbootstrap as tb
 
 from HiConA.Backend.HiConAWorkFlowHandler import HiConAWorkflowHandler
 from HiConA.Backend.ImageJ_singleton import ImageJSingleton
+from HiConA.Backend.Cellpose_singleton import CellposeSingleton
 from HiConA.Utilities.ConfigReader import ConfigReader
 
 from HiConA.GUI.GUI_HiConA import HiConAGUI
@@ -22,6 +23,7 @@ def main():
         HiConAWorkflowHandler(all_xml_readers[measurement_id], all_files[measurement_id], processes, output_dir).run()
     print("Processing finished!")
     ImageJSingleton.dispose()
+    CellposeSingleton.dispose()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,46 @@
+from HiConA.Utilities.FileManagement import WellImageIndex
+
+
+def test_parse_image_name():
+    assert WellImageIndex.parse_image_name("r02c03f11p04-ch2sk7fk1fl1.tiff") == {
+        "row": 2, "col": 3, "field": 11, "plane": 4, "channel": 2, "timepoint": 7}
+
+
+def test_parse_image_name_without_timepoint():
+    parsed = WellImageIndex.parse_image_name("r02c03f01p04-ch2.TIF")
+    assert parsed["timepoint"] == 1 and parsed["channel"] == 2
+
+
+def test_parse_image_name_t_suffix():
+    assert WellImageIndex.parse_image_name("r01c01f01p01-ch1t05.tiff")["timepoint"] == 5
+
+
+def test_parse_image_name_rejects_other_files():
+    for file_name in ("r02c03f01p04.tiff", "overview.tiff", "r02c03f01p04-ch2sk1fk1fl1.png", "Index.xml"):
+        assert WellImageIndex.parse_image_name(file_name) is None
+
+
+def test_images_sorted_by_plane_then_channel(tmp_path):
+    names = [f"r01c01f{f:02d}p{p:02d}-ch{c}sk{t}fk1fl1.tiff"
+             for f in (1, 2) for p in (2, 1, 10) for c in (2, 1) for t in (1, 2)]
+    for name in names + ["._r01c01f01p01-ch1sk1fk1fl1.tiff", "thumbnail.png"]:
+        (tmp_path / name).touch()
+
+    index = WellImageIndex(str(tmp_path))
+    assert index.fields == [1, 2] and index.timepoints == [1, 2]
+    images = [path.rsplit("/", 1)[-1] for path in index.get_images(2, 2)]
+    assert images == [f"r01c01f02p{p:02d}-ch{c}sk2fk1fl1.tiff" for p in (1, 2, 10) for c in (1, 2)]
+    assert index.get_images(3) == []
+
+
+def test_names_without_timepoint_are_filed_under_timepoint_1(tmp_path):
+    # A well re-imaged with a timelapse keeps its untimed images next to the sk/t ones
+    names = ["r01c01f01p01-ch1.tiff", "r01c01f01p01-ch2.tiff",
+             "r01c01f01p01-ch1sk2fk1fl1.tiff", "r01c01f01p01-ch2t02.tiff"]
+    for name in names:
+        (tmp_path / name).touch()
+
+    index = WellImageIndex(str(tmp_path))
+    assert index.timepoints == [1, 2]
+    assert [path.rsplit("/", 1)[-1] for path in index.get_images(1)] == names[:2]
+    assert [path.rsplit("/", 1)[-1] for path in index.get_images(1, 2)] == names[2:]
@@ -0,0 +1,75 @@
+import numpy as np
+
+from HiConA.Utilities.Image_Utils import convert_to_8bit, decode_label_rle, encode_label_rle
+
+
+def test_full_range_maps_uint16_to_uint8():
+    image = np.array([[0, 300, 32768, 65535]], dtype=np.uint16)
+    assert convert_to_8bit(image, channel_axis=None).tolist() == [[0, 1, 127, 255]]
+
+
+def test_fixed_window_per_channel_is_clipped():
+    image = np.array([[[100, 200, 300]], [[1000, 1500, 2000]]], dtype=np.uint16)
+    result = convert_to_8bit(image, mode="fixed", min_value=[150, 1000], max_value=[250, 2000])
+    assert result.dtype == np.uint8
+    assert result[0].tolist() == [[0, 127, 255]]
+    assert result[1].tolist() == [[0, 127, 255]]
+
+
+def test_per_channel_stretches_each_channel():
+    image = np.array([[[10, 20]], [[40000, 50000]]], dtype=np.uint16)
+    result = convert_to_8bit(image, mode="per channel")
+    assert result.tolist() == [[[0, 255]], [[0, 255]]]
+
+
+def test_float_projection_above_uint16():
+    # Sum projections are float and can exceed the uint16 range
+    image = np.array([[0.0, 100000.0, 200000.0]], dtype=np.float32)
+    result = convert_to_8bit(image, mode="fixed", min_value=0, max_value=200000, channel_axis=None)
+    assert result.tolist() == [[0, 127, 255]]
+
+
+def test_hyperstack_matches_plane_by_plane():
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 65536, (2, 3, 20, 16)).astype(np.uint16)  # TCYX
+    result = convert_to_8bit(image, mode="per channel", chunk_rows=7)
+    for ch in range(3):
+        expected = convert_to_8bit(image[:, ch], mode="fixed", min_value=int(image[:, ch].min()),
+                                   max_value=int(image[:, ch].max()), channel_axis=None)
+        assert np.array_equal(result[:, ch], expected)
+
+
+def test_float_window_maximum_maps_to_255():
+    # Windows whose 255 / range is not exact in float32 must still reach 255 at the maximum
+    for max_value in (3.0, 7.0, 1234.5678, 98765.4321):
+        image = np.array([[0.0, max_value, max_value + 1]], dtype=np.float32)
+        result = convert_to_8bit(image, mode="fixed", min_value=0, max_value=max_value, channel_axis=None)
+        assert result.tolist() == [[0, 255, 255]]
+
+
+def test_label_rle_round_trip():
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 4, (37, 23)).astype(np.uint16) * rng.integers(0, 2, (37, 23)).astype(np.uint16)
+    for chunk_rows in (1, 5, 1024):
+        starts, lengths, values = encode_label_rle(labels, chunk_rows=chunk_rows)
+        assert np.all(values > 0)
+        assert lengths.sum() == np.count_nonzero(labels)
+        decoded = decode_label_rle(labels.shape, starts, lengths, values)
+        assert decoded.dtype == labels.dtype
+        assert np.array_equal(decoded, labels)
+
+
+def test_label_rle_runs():
+    labels = np.array([[0, 1, 1, 2],
+                       [2, 2, 0, 0]], dtype=np.uint32)
+    starts, lengths, values = encode_label_rle(labels)
+    assert starts.tolist() == [1, 3]
+    assert lengths.tolist() == [2, 3]
+    assert values.tolist() == [1, 2]
+
+
+def test_label_rle_of_background():
+    labels = np.zeros((4, 5), dtype=np.uint16)
+    starts, lengths, values = encode_label_rle(labels)
+    assert len(starts) == len(lengths) == len(values) == 0
+    assert np.array_equal(decode_label_rle(labels.shape, starts, lengths, values), labels)
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from HiConA.Backend.HiConAMeasurement import measure_labels
+
+
+def _measure(labels, image=None):
+    if image is None:
+        image = np.ones(labels.shape, dtype=np.uint16)
+    return measure_labels(image, labels).set_index("Label")
+
+
+def test_square_is_round():
+    labels = np.zeros((20, 20), dtype=np.uint16)
+    labels[5:15, 5:15] = 1
+    row = _measure(labels).loc[1]
+    assert row["Area"] == 100
+    assert row["Perim."] == pytest.approx(40 - 4 * (2 - np.sqrt(2)))
+    assert row["AR"] == pytest.approx(1.0)
+    assert row["Round"] == pytest.approx(1.0)
+
+
+def test_rectangle_shape_descriptors():
+    labels = np.zeros((30, 40), dtype=np.uint16)
+    labels[10:20, 5:25] = 1
+    row = _measure(labels).loc[1]
+    assert row["AR"] == pytest.approx(2.0)
+    assert row["Round"] == pytest.approx(0.5)
+
+
+def test_disc_is_round():
+    y, x = np.mgrid[:101, :101]
+    labels = ((y - 50) ** 2 + (x - 50) ** 2 <= 40 ** 2).astype(np.uint16)
+    row = _measure(labels).loc[1]
+    assert row["Area"] == np.count_nonzero(labels)
+    assert row["AR"] == pytest.approx(1.0, abs=1e-3)
+    assert row["Round"] == pytest.approx(1.0, abs=1e-3)
+    # ImageJ traces this disc with a perimeter of 265.42, circularity 0.896
+    assert row["Perim."] == pytest.approx(265.42, rel=0.01)
+    assert row["Circ."] == pytest.approx(0.896, abs=0.01)
+
+
+def test_single_pixel():
+    labels = np.zeros((5, 5), dtype=np.uint16)
+    labels[2, 2] = 1
+    row = _measure(labels).loc[1]
+    assert row["Area"] == 1
+    assert row["Perim."] == pytest.approx(4 - 2 * (2 - np.sqrt(2)))
+    assert row["AR"] == pytest.approx(1.0)
+    assert row["Round"] == pytest.approx(1.0)
+    assert row["Circ."] == 1
+
+
+def test_intensity_columns_per_channel():
+    labels = np.zeros((4, 6), dtype=np.uint16)
+    labels[:, :3] = 1
+    labels[:, 3:] = 2
+    image = np.stack([np.arange(24, dtype=np.uint16).reshape(4, 6), np.full((4, 6), 7, dtype=np.uint16)])
+    table = measure_labels(image, labels, pixel_size_um=0.5)
+    first = table[(table["Label"] == 1) & (table["Channel"] == 1)].iloc[0]
+    values = image[0][labels == 1]
+    assert first["Area"] == pytest.approx(12 * 0.25)
+    assert first["Mean"] == pytest.approx(values.mean())
+    assert first["StdDev"] == pytest.approx(values.std(ddof=1))
+    assert (first["Min"], first["Max"]) == (values.min(), values.max())
+    second = table[(table["Label"] == 2) & (table["Channel"] == 2)].iloc[0]
+    assert second["Mode"] == 7 and second["StdDev"] == 0
+
+
+def test_chunked_measurements_match():
+    rng = np.random.default_rng(0)
+    labels = np.zeros((64, 64), dtype=np.uint16)
+    for label in range(1, 9):
+        y, x = rng.integers(0, 56, 2)
+        labels[y:y + 8, x:x + 8] = label
+    image = rng.integers(0, 4096, (2, 64, 64)).astype(np.uint16)
+    whole = measure_labels(image, labels)
+    chunked = measure_labels(image, labels, chunk_rows=5)
+    np.testing.assert_allclose(whole.to_numpy(dtype=float), chunked.to_numpy(dtype=float), equal_nan=True)
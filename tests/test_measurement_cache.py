@@ -0,0 +1,28 @@
+from HiConA.Utilities import MeasurementCache as measurement_cache
+from HiConA.Utilities.MeasurementCache import MeasurementCache
+
+
+def test_invalid_measurement_is_cached(tmp_path, monkeypatch):
+    measurement_path = tmp_path / "not_a_measurement"
+    measurement_path.mkdir()
+    cache = MeasurementCache(str(tmp_path))
+    assert cache.get_or_build(str(measurement_path)) is None
+    cache.save()
+
+    # A fresh scan answers from the cache without opening the measurement again
+    def fail(*args):
+        raise AssertionError("measurement parsed again")
+    monkeypatch.setattr(measurement_cache, "FilePathHandler", fail)
+    cache = MeasurementCache(str(tmp_path))
+    assert cache.get_or_build(str(measurement_path)) is None
+    assert cache.records["not_a_measurement"]["valid"] is False
+
+
+def test_changed_invalid_measurement_is_parsed_again(tmp_path):
+    measurement_path = tmp_path / "not_a_measurement"
+    measurement_path.mkdir()
+    cache = MeasurementCache(str(tmp_path))
+    cache.get_or_build(str(measurement_path))
+
+    (measurement_path / "images").mkdir()
+    assert cache.get(str(measurement_path)) is None
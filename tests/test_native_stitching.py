@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pytest
+
+from HiConA.Backend.HiConANativeStitching import fuse_well, normalised_cross_correlation, phase_correlation
+
+
+class _XMLReader:
+    def get_pixel_scale(self):
+        return 0.5
+
+    def get_channel_order(self):
+        return ["ch1", "ch2"]
+
+
+def _timelapse_tiles():
+    rng = np.random.default_rng(0)
+    tiles = [rng.integers(0, 1000, (3, 2, 64, 64)).astype(np.uint16) for _ in range(2)]
+    return tiles, np.array([[0.0, 0.0], [0.0, 48.0]])
+
+
+def test_small_timelapse_is_fused_in_memory():
+    tiles, positions = _timelapse_tiles()
+    fused, path = fuse_well(tiles, positions, _XMLReader(), memory_mb=64, axes="TCYX")
+    assert path is None and fused.shape == (3, 2, 64, 112)
+    assert np.array_equal(fused[1, :, :, :48], tiles[0][1, :, :, :48])
+
+
+def test_large_timelapse_without_output_path_is_fused_out_of_core():
+    tiles, positions = _timelapse_tiles()
+    in_memory, _ = fuse_well(tiles, positions, _XMLReader(), axes="TCYX")
+    fused, path = fuse_well(tiles, positions, _XMLReader(), memory_mb=0.01, axes="TCYX")
+    try:
+        assert path is not None and os.path.isfile(path)
+        assert isinstance(fused, np.memmap)
+        assert np.array_equal(fused, in_memory)
+    finally:
+        del fused
+        os.remove(path)
+
+
+def _smooth_image(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    image = rng.random((shape[0] + 8, shape[1] + 8))
+    # Box blur, so the correlation peak does not depend on single noisy pixels
+    image = sum(np.roll(np.roll(image, dy, 0), dx, 1) for dy in range(-2, 3) for dx in range(-2, 3))
+    return image[4:-4, 4:-4]
+
+
+def test_phase_correlation_finds_shift():
+    canvas = _smooth_image((160, 160))
+    image_a = canvas[20:120, 30:130]
+    for shift in ((0, 0), (5, -7), (-12, 9)):
+        image_b = canvas[20 + shift[0]:120 + shift[0], 30 + shift[1]:130 + shift[1]]
+        assert phase_correlation(image_a, image_b) == shift
+        # image_b[k] matches image_a[k + shift] over the overlap
+        assert normalised_cross_correlation(image_a, image_b, shift) == pytest.approx(1.0)
+
+
+def test_phase_correlation_ignores_intensity_offset():
+    canvas = _smooth_image((160, 160), seed=1)
+    image_a = canvas[10:110, 10:110]
+    image_b = 3 * canvas[14:114, 7:107] + 100
+    assert phase_correlation(image_a, image_b) == (4, -3)
+
+
+def test_normalised_cross_correlation_without_overlap():
+    image = _smooth_image((32, 32))
+    assert normalised_cross_correlation(image, image, (32, 0)) == 0.0
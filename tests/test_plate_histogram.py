@@ -0,0 +1,56 @@
+import numpy as np
+
+from HiConA.Backend.HiConAPlateHistogram import HiConAPlateHistogram
+
+
+def test_uint16_window_is_exact():
+    image = np.arange(1000, dtype=np.uint16).reshape(1, 10, 100)
+    histogram = HiConAPlateHistogram(1, subsample=1).add_image(image)
+    mins, maxs = histogram.get_window(0, 100)
+    assert mins == [0] and maxs == [999]
+
+
+def test_sum_projection_above_uint16_is_not_saturated():
+    # A Sum projection of 10 planes reaches ~600000
+    image = np.linspace(0, 600000, 10000, dtype=np.float32).reshape(1, 100, 100)
+    histogram = HiConAPlateHistogram(1, subsample=1).add_image(image)
+    mins, maxs = histogram.get_window(0.1, 99.9)
+    assert histogram.bin_widths[0] == 16
+    assert 590000 < maxs[0] <= 600000 + 16
+    assert mins[0] < 1000
+
+
+def test_bin_width_grows_across_images_without_losing_counts():
+    histogram = HiConAPlateHistogram(1, subsample=1)
+    histogram.add_image(np.full((1, 10, 10), 1000.0))
+    histogram.add_image(np.full((1, 10, 10), 200000.0))
+    assert histogram.histograms.sum() == 200
+    mins, maxs = histogram.get_window(0, 100)
+    assert mins[0] <= 1000 < mins[0] + histogram.bin_widths[0]
+    assert maxs[0] >= 200000
+
+
+def test_subsampled_images_are_not_subsampled_again():
+    image = np.ones((1, 8, 8), dtype=np.uint16)
+    assert HiConAPlateHistogram(1, subsample=4).add_image(image).histograms.sum() == 4
+    assert HiConAPlateHistogram(1, subsample=4).add_image(image, subsampled=True).histograms.sum() == 64
+
+
+def test_cache_round_trip_keeps_bin_widths(tmp_path):
+    key = {"proj": "Sum", "subsample": 1}
+    histogram = HiConAPlateHistogram(1, subsample=1).add_image(np.full((1, 4, 4), 300000.0))
+    histogram.save(tmp_path / "plate_histograms.npz", key)
+
+    cached = HiConAPlateHistogram.load(str(tmp_path / "plate_histograms.npz"), key)
+    assert cached.get_window(0, 100) == histogram.get_window(0, 100)
+    assert HiConAPlateHistogram.load(str(tmp_path / "plate_histograms.npz"), {**key, "focus_metric": "variance"}) is None
+
+
+def test_cache_of_another_measurement_of_the_plate_is_not_used(tmp_path):
+    # Measurements of one plate share the output dir, a re-imaged plate has the same wells but a new GUID
+    key = {"measurement": "guid-first", "proj": "Maximum", "subsample": 4, "wells": ["r01c01", "r01c02"]}
+    cache_path = str(tmp_path / "plate_histograms.npz")
+    HiConAPlateHistogram(2, subsample=4).add_image(np.full((2, 8, 8), 1000, dtype=np.uint16)).save(cache_path, key)
+
+    assert HiConAPlateHistogram.load(cache_path, key) is not None
+    assert HiConAPlateHistogram.load(cache_path, {**key, "measurement": "guid-reimaged"}) is None
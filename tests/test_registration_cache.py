@@ -0,0 +1,29 @@
+import numpy as np
+
+from HiConA.Backend.HiConARegistrationCache import HiConARegistrationCache
+
+
+class FakeXMLReader:
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+    def get_well_layout(self):
+        return {"r02c02": [[0, 0], [0, 1]], "r02c03": [[0, 0], [0, 1]]}
+
+    def get_well_sublayouts(self):
+        return {"r02c02": 0, "r02c03": 0}
+
+
+def test_positions_of_another_backend_are_not_reused(tmp_path):
+    xml_file = tmp_path / "Index.xml"
+    xml_file.write_text("<plate/>")
+    positions = np.array([[0.0, 0.0], [0.0, 1000.0]])
+
+    fiji_cache = HiConARegistrationCache(FakeXMLReader(str(xml_file)), str(tmp_path), mode="sample wells", sample_wells=1)
+    fiji_cache.add("r02c02", positions)
+    assert np.array_equal(fiji_cache.get("r02c02"), positions)
+
+    python_cache = HiConARegistrationCache(FakeXMLReader(str(xml_file)), str(tmp_path), mode="sample wells",
+                                           sample_wells=1, backend="Python")
+    assert python_cache.get("r02c02") is None
+    assert python_cache.get("r02c03") is None
@@ -0,0 +1,88 @@
+import numpy as np
+from scipy import ndimage
+
+from HiConA.Backend.HiConATiledSegmentation import get_blocks, get_written_mask, merge_block_labels, segment_tiled
+
+# Two blocks of a (10, 16) image, overlapping in columns 6-9
+BLOCK_A = (0, 10, 0, 10)
+BLOCK_B = (0, 10, 6, 16)
+
+
+def _merge_two_blocks(labels_a, labels_b):
+    out = np.zeros((10, 16), dtype=np.uint32)
+    next_label = merge_block_labels(out, labels_a, 0, 0, get_written_mask(BLOCK_A, []), 1)
+    next_label = merge_block_labels(out, labels_b, 0, 6, get_written_mask(BLOCK_B, [BLOCK_A]), next_label)
+    return out, next_label
+
+
+def test_get_written_mask_marks_overlap_with_earlier_blocks():
+    written = get_written_mask(BLOCK_B, [BLOCK_A])
+    assert written[:, :4].all()
+    assert not written[:, 4:].any()
+
+
+def test_cell_across_the_seam_keeps_one_id():
+    labels_a = np.zeros((10, 10), dtype=np.int32)
+    labels_a[2:5, 4:10] = 1
+    labels_b = np.zeros((10, 10), dtype=np.int32)
+    labels_b[2:5, 0:6] = 1  # columns 6-11 of the image
+
+    out, next_label = _merge_two_blocks(labels_a, labels_b)
+
+    assert next_label == 2
+    assert np.array_equal(np.unique(out), [0, 1])
+    assert (out[2:5, 4:12] == 1).all()
+
+
+def test_iou_counts_block_label_on_written_background():
+    # A small cell of block A lies inside a much larger block B label, most of which is on background
+    # that block A already wrote, so the IoU is 4 / 32 and the labels stay separate
+    labels_a = np.zeros((10, 10), dtype=np.int32)
+    labels_a[0:2, 8:10] = 1
+    labels_b = np.zeros((10, 10), dtype=np.int32)
+    labels_b[0:8, 0:4] = 1
+
+    out, next_label = _merge_two_blocks(labels_a, labels_b)
+
+    assert next_label == 3
+    assert (out[0:2, 8:10] == 1).all()
+    assert (out[2:8, 6:10] == 2).all()
+
+
+def test_labels_without_pixels_to_write_get_no_id():
+    labels_a = np.zeros((10, 10), dtype=np.int32)
+    labels_a[0:4, 6:10] = 1
+    labels_b = np.zeros((10, 10), dtype=np.int32)
+    labels_b[0, 0] = 1  # unmatched (IoU 1/16) and covered by label 1 already
+    labels_b[6:8, 6:8] = 2
+
+    out, next_label = _merge_two_blocks(labels_a, labels_b)
+
+    assert next_label == 3
+    assert np.array_equal(np.unique(out), [0, 1, 2])
+
+
+def test_segment_tiled_matches_global_labelling():
+    rng = np.random.default_rng(0)
+    image = np.zeros((300, 260))
+    for y, x in rng.integers(5, 250, size=(40, 2)):
+        image[y:y + 6, x:x + 6] = 1  # objects much smaller than the overlap
+
+    def segment(block):
+        labels, count = ndimage.label(block[0] > 0)
+        return labels, count
+
+    out = np.zeros(image.shape, dtype=np.uint32)
+    segment_tiled(image[np.newaxis], segment, out, block_size=100, overlap=30)
+
+    _, num_global = ndimage.label(image > 0)
+    assert len(np.unique(out)) - 1 == num_global
+    assert out.max() == num_global
+    assert np.array_equal(out > 0, image > 0)
+
+
+def test_get_blocks_cover_the_image():
+    covered = np.zeros((250, 170), dtype=bool)
+    for y0, y1, x0, x1 in get_blocks(covered.shape, block_size=100, overlap=20):
+        covered[y0:y1, x0:x1] = True
+    assert covered.all()
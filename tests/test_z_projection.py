@@ -0,0 +1,16 @@
+import numpy as np
+
+from HiConA.Backend.HiConAZProjection import HiConAZProjector
+
+
+def test_channel_without_planes_is_zero():
+    projector = HiConAZProjector(["Maximum", "Mean", "Standard Deviation"], num_channels=2)
+    for value in (3, 5):
+        projector.add_plane(0, np.full((4, 4), value, dtype=np.uint16))
+
+    images = projector.get_images()
+    assert images["Maximum"][0].tolist() == np.full((4, 4), 5).tolist()
+    for projection in ("Maximum", "Mean", "Standard Deviation"):
+        assert not np.isnan(images[projection]).any()
+        assert not images[projection][1].any()
+    assert np.allclose(images["Mean"][0], 4) and np.allclose(images["Standard Deviation"][0], 1)